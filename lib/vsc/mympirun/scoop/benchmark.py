@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmark the launcher side of myscoop: command construction and launch overhead
+
+Runs MYSCOOP.scoop_run against a list of fake hosts with a stub launcher:
+the broker is started as usual, but no worker is started (no ssh, no mpirun, no tree agents,
+the root process that scoop waits for and reads from is a stub command);
+the worker commands are built (and the mpi commands file or tree spec written) exactly as for a real launch.
+Each number of workers is benchmarked in a forked process, so the peak memory (maxrss) is per run.
+
+e.g. python -m vsc.mympirun.scoop.benchmark --sizes=1000,10000,100000 --launcher=mpi --freeorigin
+"""
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from optparse import Values
+
+from vsc.mympirun.rm.local import Local
+from vsc.mympirun.scoop.myscoop import MYSCOOP, MyScoopApp, MyHost
+from vsc.utils.generaloption import simple_option
+
+FAKE_HOSTNAME_TEMPLATE = 'benchnode%05d'
+# the stub root process
+ROOT_PROCESS_COMMAND = ['true']
+
+# phase order in the report
+PHASES = ['init', 'environment', 'addworker', 'command', 'launch', 'run']
+
+
+class Phases(object):
+    """Cumulative time and peak memory per phase"""
+    def __init__(self):
+        self.times = dict([(phase, 0.0) for phase in PHASES])
+        self.maxrss = dict([(phase, 0) for phase in PHASES])
+
+    def add(self, phase, start):
+        """Add the time since start to phase"""
+        self.times[phase] += time.time() - start
+        self.maxrss[phase] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def report(self):
+        """Return list of (phase, time in s, maxrss in kB)"""
+        return [(phase, self.times[phase], self.maxrss[phase]) for phase in PHASES]
+
+_phases = Phases()
+
+
+class FakeProcess(object):
+    """Stands in for the Popen instance of the launch of a host that is not the root process"""
+    pid = 0
+    returncode = 0
+    stdout = None
+    stderr = None
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        pass
+
+    def kill(self):
+        pass
+
+
+def start_root_process(std_pipe=False):
+    """Start the stub root process: a real Popen (piped as for a real launch) that exits immediately"""
+    if std_pipe:
+        return subprocess.Popen(ROOT_PROCESS_COMMAND, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+        return subprocess.Popen(ROOT_PROCESS_COMMAND)
+
+
+class BenchHost(MyHost):
+    """Build the command of the host, only the host with the origin worker starts the stub root process"""
+    def launch(self, tunnelPorts=None, stdPipe=False):
+        s_t = time.time()
+        self.getCommand()
+        _phases.add('command', s_t)
+
+        if any([worker.origin for worker in self.workersArguments]):
+            self.subprocesses.append(start_root_process(std_pipe=stdPipe))
+        else:
+            self.subprocesses.append(FakeProcess())
+        return self.subprocesses
+
+
+class BenchScoopApp(MyScoopApp):
+    """With the mpi and tree launchers, the hosts are MyCollectiveHost (the collective launch is stubbed)"""
+    LAUNCH_HOST_CLASS = BenchHost
+
+    def _addWorker_args(self, workerinfo):
+        s_t = time.time()
+        res = super(BenchScoopApp, self)._addWorker_args(workerinfo)
+        _phases.add('addworker', s_t)
+        return res
+
+
+class BenchMYSCOOP(MYSCOOP, Local):
+    """MYSCOOP with fake hosts and a stub launcher
+        the local scheduler only provides what MPI needs (sched_id, ...), the hosts are the fake ones in the options
+    """
+    SCOOP_APP = BenchScoopApp
+
+    def get_pass_variables(self):
+        """Only the startup variables (the mympirun option parsing is not benchmarked)"""
+        return self.SCOOP_STARTUP_VARIABLES[:]
+
+    def get_localhosts(self):
+        """None of the fake hosts is local"""
+        return []
+
+    def scoop_make_environment(self):
+        s_t = time.time()
+        res = super(BenchMYSCOOP, self).scoop_make_environment()
+        _phases.add('environment', s_t)
+        return res
+
+    def scoop_launch_collective(self, hosts, std_pipe=False):
+        """Build the commands of the collective launch, only start the stub root process"""
+        s_t = time.time()
+        if self.scoop_launcher == 'mpi':
+            self.scoop_make_mpi_commands(hosts)
+        elif self.scoop_launcher == 'tree':
+            self.scoop_make_tree_spec(hosts)
+        _phases.add('launch', s_t)
+        return [start_root_process(std_pipe=std_pipe)]
+
+    def scoop_close_collective(self, hosts):
+        """No agents or workers were started"""
+        pass
+
+
+def make_options(go, size):
+    """Return the options for BenchMYSCOOP with size workers on fake hosts"""
+    nr_hosts = (size + go.options.ppn - 1) // go.options.ppn
+    hosts = []
+    for idx in range(nr_hosts):
+        hosts.extend([FAKE_HOSTNAME_TEMPLATE % idx] * go.options.ppn)
+
+    return Values({
+        'debug': go.options.debug,
+        # for the local scheduler
+        'multi': None,
+        'double': False,
+        'hybrid': None,
+        'scoop_size': size,
+        'scoop_hosts': hosts[:size],
+        'scoop_broker': socket.gethostname(),
+        'scoop_verbose': 0,
+        'scoop_launcher': go.options.launcher,
+        'scoop_freeorigin': go.options.freeorigin,
+        'scoop_zygote': go.options.zygote,
+        'scoop_affinity': go.options.affinity,
+        'scoop_processcontrol': 'VSC',
+    })
+
+
+def run_size(go, size):
+    """Benchmark scoop_run with size workers, returns the phase report"""
+    global _phases
+    _phases = Phases()
+
+    executable = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker', 'simple_shell.py')
+
+    s_t = time.time()
+    myscoop = BenchMYSCOOP(make_options(go, size), [executable, 'true'])
+    myscoop.mympirundir = tempfile.mkdtemp(prefix='scoop_benchmark_')
+    _phases.add('init', s_t)
+
+    s_t = time.time()
+    try:
+        myscoop.scoop_run()
+    finally:
+        _phases.add('run', s_t)
+        shutil.rmtree(myscoop.mympirundir)
+
+    return _phases.report()
+
+
+def run_size_forked(go, size):
+    """Run run_size in a forked process, returns the phase report (None if it failed)"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        ec = 0
+        try:
+            os.write(wfd, json.dumps(run_size(go, size)).encode('utf-8'))
+        except:
+            ec = 1
+            sys.stderr.write("benchmark: size %s failed\n" % size)
+            traceback.print_exc()
+        os.close(wfd)
+        os._exit(ec)
+
+    os.close(wfd)
+    data = []
+    while True:
+        txt = os.read(rfd, 65536)
+        if not txt:
+            break
+        data.append(txt)
+    os.close(rfd)
+    status = os.waitpid(pid, 0)[1]
+
+    if status != 0 or not data:
+        return None
+    return json.loads(b''.join(data).decode('utf-8'))
+
+
+def main():
+    options = {
+        'sizes': ("Number of workers to benchmark", 'strlist', 'store', ['1000', '10000', '100000']),
+        'ppn': ("Number of workers per fake host", 'int', 'store', 16),
+        'launcher': ("Launcher to benchmark", 'choice', 'store', MYSCOOP.SCOOP_LAUNCHER_DEFAULT,
+                     MYSCOOP.SCOOP_LAUNCHERS),
+        'freeorigin': ("Run the origin worker as an extra process", None, 'store_true', False),
+        'zygote': ("Use a zygote per host", None, 'store_true', False),
+        'affinity': ("Affinity algorithm", 'str', 'store', 'basiccore'),
+        'json': ("Print the results as json", None, 'store_true', False),
+    }
+    go = simple_option(options)
+
+    ec = 0
+    results = []
+    for size in [int(x) for x in go.options.sizes]:
+        report = run_size_forked(go, size)
+        results.append({'size': size, 'launcher': go.options.launcher, 'phases': report})
+        if report is None:
+            ec = 1
+
+        if not go.options.json:
+            if report is None:
+                print("size %s: failed" % size)
+                continue
+            for phase, phase_time, maxrss in report:
+                print("size %7d phase %-12s time %10.4fs maxrss %8d kB" % (size, phase, phase_time, maxrss))
+
+    if go.options.json:
+        print(json.dumps(results))
+    sys.exit(ec)
+
+if __name__ == '__main__':
+    main()
@@ -36,12 +36,24 @@ import vsc.processcontrol
 from distutils.version import LooseVersion
 from scoop import futures
 from scoop.bootstrap.__main__ import Bootstrap
-from vsc.mympirun.scoop.worker_utils import set_scoop_env
+from vsc.mympirun.scoop.membind import set_membind
+from vsc.mympirun.scoop.topology import PLANNED_ALGORITHMS, HYBRID_ALGORITHM, make_cpulist, parse_cpulist
+from vsc.mympirun.scoop.topology import get_topology, get_allowed_cpus
+from vsc.mympirun.scoop.worker_utils import set_scoop_env, get_scoop_env, apply_environment
 from vsc.processcontrol.affinity import what_affinity
 from vsc.processcontrol.priority import what_priority
+from vsc.utils.affinity import cpu_set_t, sched_setaffinity
 
 
 class MyBootstrap(Bootstrap):
+    # used for the planned algorithms when the topology of the node can't be determined
+    AFFINITY_FALLBACK = 'basiccore'
+    # set to the number of cores of the worker with the hybrid affinity
+    HYBRID_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']
+    HYBRID_FIXED_VARIABLES = {'OMP_PROC_BIND': 'close',
+                              'OMP_PLACES': 'cores',
+                              }
+
     def makeParser(self):
         super(MyBootstrap, self).makeParser()
 
@@ -70,15 +82,42 @@ class MyBootstrap(Bootstrap):
                                  default=None
                                  )
 
+        self.parser.add_argument('--membind',
+                                 help="NUMA memory policy mode",
+                                 action='store',
+                                 default=None
+                                 )
+
+        self.parser.add_argument('--environment',
+                                 help="Environment snapshot file",
+                                 action='store',
+                                 default=None
+                                 )
+
+        self.parser.add_argument('--placement',
+                                 help="Global rank, index on the host and number of workers on the host",
+                                 action='store',
+                                 default=None
+                                 )
+
     def parse(self):
         super(MyBootstrap, self).parse()
 
         # custom
+        self.load_environment()
         self.set_freeorigin()
         self.set_nice()
         self.set_affinity()
+        self.set_membind()
         self.set_environment()
 
+    def load_environment(self):
+        """Set the variables passed by the launcher in the environment snapshot"""
+        if self.args.environment is None:
+            return
+
+        apply_environment(self.args.environment)
+
     def set_freeorigin(self):
         """Freeorigin mode
             prevent origin worker to do any work
@@ -109,6 +148,12 @@ class MyBootstrap(Bootstrap):
 
         affinityargs = self.args.affinity.split(':')
         algo = affinityargs.pop(0)
+        if algo in PLANNED_ALGORITHMS:
+            if self.set_affinity_planned(algo, *affinityargs):
+                return
+            self.log.warning("set_affinity no topology found, falling back to %s" % self.AFFINITY_FALLBACK)
+            algo = self.AFFINITY_FALLBACK
+
         control = what_affinity(mode=self.args.processcontrol,
                                 algo=algo
                                 )
@@ -120,10 +165,77 @@ class MyBootstrap(Bootstrap):
             c = control[0]()
             c.algorithm(*affinityargs)
 
+    def set_affinity_planned(self, algo, total_workers_host, worker_idx_host):
+        """Plan the cpus and NUMA node of this worker from the topology (and cpuset) of this node and apply them
+            the placement is only exported when the pinning succeeded
+            returns False if the topology can't be determined (nothing is set)
+        """
+        topology = get_topology()
+        if topology is None:
+            return False
+
+        cpus, node = topology.plan(int(total_workers_host))[int(worker_idx_host)]
+        cpulist = make_cpulist(cpus)
+
+        cs = cpu_set_t()
+        cs.convert_hr_bits(cpulist)
+        cs.set_bits()
+        # only logs when it fails
+        sched_setaffinity(cs)
+
+        allowed = get_allowed_cpus()
+        if allowed is None or sorted(allowed) != cpus:
+            self.log.error("set_affinity_planned failed to pin to cpus %s (allowed cpus %s), placement not exported" %
+                           (cpulist, allowed and make_cpulist(allowed)))
+            return True
+
+        set_scoop_env('worker_cpus', cpulist)
+        set_scoop_env('worker_numa_node', node)
+
+        if algo == HYBRID_ALGORITHM:
+            self.set_hybrid_variables(cpulist, topology.nr_cores(cpus))
+        return True
+
+    def set_hybrid_variables(self, cpus, nr_threads):
+        """Export the thread count and pinning variables for the block of cores of this worker
+            the whole block is one Intel MPI pinning domain
+        """
+        for name in self.HYBRID_THREAD_VARIABLES:
+            os.environ[name] = "%s" % nr_threads
+        os.environ.update(self.HYBRID_FIXED_VARIABLES)
+
+        mask = sum([1 << cpu for cpu in parse_cpulist(cpus)])
+        os.environ['I_MPI_PIN_DOMAIN'] = "[%x]" % mask
+
+        set_scoop_env('worker_threads', nr_threads)
+
+    def set_membind(self):
+        """Set the NUMA memory policy, matching the affinity set before"""
+        if self.args.membind is None:
+            return
+
+        nodes = None
+        planned_node = get_scoop_env('worker_numa_node', int)
+        if planned_node is not None:
+            nodes = [planned_node]
+
+        try:
+            nodes = set_membind(self.args.membind, nodes=nodes)
+        except OSError as err:
+            self.log.error("set_membind failed: %s" % err)
+            return
+
+        set_scoop_env('worker_membind', "%s:%s" % (self.args.membind, make_cpulist(nodes)))
+
     def set_environment(self):
         """Set a number of worker environment variables"""
         set_scoop_env('worker_name', self.args.workerName)
         set_scoop_env('worker_origin', int(self.args.origin))
+        if self.args.placement is not None:
+            rank, host_index, host_workers = self.args.placement.split(':')
+            set_scoop_env('worker_rank', rank)
+            set_scoop_env('worker_host_index', host_index)
+            set_scoop_env('worker_host_workers', host_workers)
 
     def run(self):
         super(MyBootstrap, self).run(globs=globals())
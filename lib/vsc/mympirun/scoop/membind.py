@@ -0,0 +1,155 @@
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+NUMA memory policy of the worker (set_mempolicy/get_mempolicy)
+
+The calls go through libnuma when it is available, otherwise through the raw syscall.
+Only the policy of the calling process is changed (as with numactl), so it has to be set
+before the worker allocates its data.
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+
+from vsc.mympirun.scoop.topology import get_topology, parse_cpulist, make_cpulist, read_file, PROC_STATUS
+
+# from linux/mempolicy.h
+MPOL_DEFAULT = 0
+MPOL_PREFERRED = 1
+MPOL_BIND = 2
+MPOL_INTERLEAVE = 3
+MPOL_LOCAL = 4
+
+MEMBIND_MODES = {
+    'local': MPOL_LOCAL,
+    'preferred': MPOL_PREFERRED,
+    'bind': MPOL_BIND,
+}
+MEMBIND_NAMES = dict([(mode, name) for name, mode in MEMBIND_MODES.items()] +
+                     [(MPOL_DEFAULT, 'default'), (MPOL_INTERLEAVE, 'interleave')])
+
+# syscall numbers, only used without libnuma
+SYSCALL_NUMBERS = {
+    'x86_64': (238, 239),  # set_mempolicy, get_mempolicy
+    'i686': (276, 275),
+    'aarch64': (237, 236),
+    'ppc64': (261, 260),
+    'ppc64le': (261, 260),
+}
+
+MAX_NODES = 1024
+_BITS_PER_LONG = 8 * ctypes.sizeof(ctypes.c_ulong)
+_NODEMASK_T = ctypes.c_ulong * (MAX_NODES // _BITS_PER_LONG)
+
+_mempolicy = None
+
+
+def _get_mempolicy_functions():
+    """Return (set_mempolicy, get_mempolicy) as ctypes callables, None if not supported"""
+    global _mempolicy
+    if _mempolicy is None:
+        libnuma = ctypes.util.find_library('numa')
+        if libnuma is not None:
+            lib = ctypes.CDLL(libnuma, use_errno=True)
+            _mempolicy = (lib.set_mempolicy, lib.get_mempolicy)
+        elif platform.machine() in SYSCALL_NUMBERS:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            set_nr, get_nr = SYSCALL_NUMBERS[platform.machine()]
+            _mempolicy = (lambda *args: libc.syscall(set_nr, *args),
+                          lambda *args: libc.syscall(get_nr, *args))
+        else:
+            _mempolicy = False
+    return _mempolicy or None
+
+
+def _make_nodemask(nodes):
+    """Return nodemask with the bits of nodes set"""
+    mask = _NODEMASK_T()
+    for node in nodes:
+        mask[node // _BITS_PER_LONG] |= 1 << (node % _BITS_PER_LONG)
+    return mask
+
+
+def _nodes_from_nodemask(mask):
+    """Return sorted list of nodes set in nodemask"""
+    return [node for node in range(MAX_NODES) if mask[node // _BITS_PER_LONG] >> (node % _BITS_PER_LONG) & 1]
+
+
+def get_affinity_nodes():
+    """Return the sorted list of NUMA nodes of the cpus this process is pinned to"""
+    status = read_file(PROC_STATUS, '')
+    cpus = None
+    for line in status.splitlines():
+        if line.startswith('Cpus_allowed_list:'):
+            cpus = parse_cpulist(line.split(':', 1)[1])
+    topology = get_topology()
+    if cpus is None or topology is None:
+        return []
+    return sorted(set([topology.numa_of[cpu] for cpu in cpus if cpu in topology.numa_of]))
+
+
+def set_membind(mode, nodes=None):
+    """Set the memory policy of this process
+        mode: one of MEMBIND_MODES
+        nodes: list of NUMA nodes (default: the nodes of the current cpu affinity), ignored for local
+            preferred only uses the first node
+        returns the nodes used, raises OSError if the policy can't be set
+    """
+    functions = _get_mempolicy_functions()
+    if functions is None:
+        raise OSError("set_membind: set_mempolicy not supported on %s" % platform.machine())
+
+    if mode == 'local':
+        nodes = []
+    else:
+        if nodes is None:
+            nodes = get_affinity_nodes()
+        if not nodes:
+            raise OSError("set_membind: no NUMA nodes found for mode %s" % mode)
+        if mode == 'preferred':
+            nodes = nodes[:1]
+
+    mask = _make_nodemask(nodes)
+    if functions[0](MEMBIND_MODES[mode], ctypes.byref(mask), MAX_NODES + 1) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "set_membind: set_mempolicy %s nodes %s failed: %s" % (mode, nodes, os.strerror(errno)))
+
+    return nodes
+
+
+def get_membind():
+    """Return (mode name, nodelist) of the memory policy of this process, None if not supported"""
+    functions = _get_mempolicy_functions()
+    if functions is None:
+        return None
+
+    mode = ctypes.c_int(0)
+    mask = _NODEMASK_T()
+    if functions[1](ctypes.byref(mode), ctypes.byref(mask), MAX_NODES + 1, None, 0) != 0:
+        return None
+
+    return MEMBIND_NAMES.get(mode.value, "%s" % mode.value), make_cpulist(_nodes_from_nodemask(mask))
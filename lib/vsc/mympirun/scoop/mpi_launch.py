@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Start SCOOP workers as the ranks of one MPI launch
+
+The launcher writes the shell command of each worker in a commands file,
+together with an index file with the offset and length of each command (fixed size text records).
+Every rank runs a small shell trampoline (see get_launch_command): it looks up its own command
+(2 small reads, independent of the number of workers) and evaluates it in the same shell,
+so no python is started per rank just to find its command.
+"""
+import os
+
+# environment variables that hold the rank, in order of preference
+RANK_ENVIRONMENT_VARIABLES = ['PMI_RANK', 'OMPI_COMM_WORLD_RANK', 'PMIX_RANK', 'MV2_COMM_WORLD_RANK', 'SLURM_PROCID']
+
+INDEX_SUFFIX = '.idx'
+# offset and length, space padded (no leading zeros, the shell arithmetic would take them as octal)
+INDEX_FORMAT = "%20d %20d\n"
+INDEX_ENTRY_SIZE = len(INDEX_FORMAT % (0, 0))
+
+# $1 is the commands file; joined on one line, some mpirun wrappers pass the arguments through a shell again
+TRAMPOLINE_TEMPLATE = [
+    'r=%(rank)s',
+    '[ -n "$r" ] || { echo "mpi_launch: no rank found in environment (tried %(names)s)" >&2; exit 1; }',
+    'e=$(dd if="$1%(suffix)s" bs=%(size)d skip="$r" count=1 2>/dev/null)',
+    '[ -n "$e" ] || { echo "mpi_launch: no command for rank $r in $1" >&2; exit 1; }',
+    'set -- "$1" $e',
+    'c=$(tail -c +$(($2 + 1)) "$1" | head -c "$3")',
+    'eval "$c"',
+]
+
+
+def write_commands(filename, commands):
+    """Write the list of commands (one per rank) and the index"""
+    offset = 0
+    cmds = open(filename, 'wb')
+    idx = open(filename + INDEX_SUFFIX, 'wb')
+    for cmd in commands:
+        cmd = cmd.encode('utf-8') if not isinstance(cmd, bytes) else cmd
+        cmds.write(cmd)
+        idx.write((INDEX_FORMAT % (offset, len(cmd))).encode('ascii'))
+        offset += len(cmd)
+    cmds.close()
+    idx.close()
+
+
+def read_command(filename, rank):
+    """Return the command for rank (as the trampoline does), None if there is none"""
+    idx = open(filename + INDEX_SUFFIX, 'rb')
+    idx.seek(rank * INDEX_ENTRY_SIZE)
+    entry = idx.read(INDEX_ENTRY_SIZE)
+    idx.close()
+    if len(entry) != INDEX_ENTRY_SIZE:
+        return None
+
+    offset, length = [int(x) for x in entry.split()]
+    cmds = open(filename, 'rb')
+    cmds.seek(offset)
+    cmd = cmds.read(length)
+    cmds.close()
+    return cmd.decode('utf-8')
+
+
+def get_trampoline():
+    """Return the shell script that runs the command of the rank, the commands file is its first argument"""
+    rank = '$%s' % RANK_ENVIRONMENT_VARIABLES[-1]
+    for name in reversed(RANK_ENVIRONMENT_VARIABLES[:-1]):
+        rank = '${%s:-%s}' % (name, rank)
+    values = {'rank': rank,
+              'names': ' '.join(RANK_ENVIRONMENT_VARIABLES),
+              'suffix': INDEX_SUFFIX,
+              'size': INDEX_ENTRY_SIZE,
+              }
+    return '; '.join([line % values for line in TRAMPOLINE_TEMPLATE])
+
+
+def get_launch_command(filename, shell=None):
+    """Return the command (list of arguments) every rank runs to start its worker
+        shell defaults to SHELL (as for the command of a single worker)
+    """
+    if shell is None:
+        shell = os.environ.get('SHELL', '/bin/sh')
+    return [shell, '-c', get_trampoline(), 'mpi_launch', filename]
@@ -29,13 +29,29 @@ SCOOP support
     based on 0.6.0  code
 """
 import itertools
+import json
 import os
+import pipes
+import shutil
+import subprocess
 import sys
+import tarfile
 from collections import namedtuple
 from distutils.version import LooseVersion
 from vsc.utils.fancylogger import getLogger
+from vsc.utils.run import run_simple
 from vsc.mympirun.mpi.mpi import MPI
 from vsc.mympirun.exceptions import WrongPythonVersionExcpetion, InitImportException
+from vsc.mympirun.scoop.mpi_launch import write_commands, get_launch_command
+from vsc.mympirun.scoop.tree_launch import DEFAULT_FANOUT, write_spec, read_spec, get_children, start_children
+from vsc.mympirun.scoop.tree_launch import get_agent_command
+from vsc.mympirun.scoop.zygote import encode_workers
+from vsc.mympirun.scoop.stage import make_archive, extract_archive
+from vsc.mympirun.scoop.membind import MEMBIND_MODES
+from vsc.mympirun.scoop.topology import TOPOLOGY_ALGORITHM, HYBRID_ALGORITHM
+from vsc.mympirun.scoop.worker_utils import write_environment, set_scoop_env, SCOOP_ENVIRONMENT_PREFIX
+from vsc.mympirun.scoop.worker_utils import SCOOP_ENVIRONMENT_SEPARATOR, RESULTS_FORMATS, RESULTS_ORDERS
+from vsc.mympirun.scoop.worker_utils import RESULTS_WINDOW
 
 _logger = getLogger("MYSCOOP")
 
@@ -56,30 +72,45 @@ from scoop import utils
 
 class MyHost(Host):
     BOOTSTRAP_MODULE = 'vsc.mympirun.scoop.bootstrap'
+    ZYGOTE_MODULE = 'vsc.mympirun.scoop.zygote'
+    STAGE_MODULE = 'vsc.mympirun.scoop.stage'
     LAUNCHING_ARGUMENTS = namedtuple(Host.LAUNCHING_ARGUMENTS.__name__,
                                      list(Host.LAUNCHING_ARGUMENTS._fields) +
                                      ['freeorigin',
                                       'processcontrol', 'affinity',
-                                      'variables', 'load_modules']
+                                      'variables', 'load_modules',
+                                      'zygote', 'stage', 'environment',
+                                      'membind', 'placement']
                                      )
 
+    def __init__(self, *args, **kwargs):
+        super(MyHost, self).__init__(*args, **kwargs)
+        # set while the host command is built, the staged archive is then extracted once in front of it
+        self._stage_per_host = False
+
     def _WorkerCommand_environment(self, worker):
         c = super(MyHost, self)._WorkerCommand_environment(worker)
 
         set_variables = self._WorkerCommand_environment_set_variables(worker.variables)
-        # TODO do we need the module load when we pass most variables?
 
+        # empty if the module environment was resolved by the launcher
         load_modules = self._WorkerCommand_environment_load_modules(worker.load_modules)
 
-        return set_variables + load_modules + c
+        if self._stage_per_host:
+            stage = []
+        else:
+            stage = self._WorkerCommand_environment_stage(worker)
+
+        return set_variables + load_modules + stage + c
 
     def _WorkerCommand_environment_set_variables(self, variables):
+        """Export the variables (dict name: value)"""
         # TODO port to env when super(MyHost, self)._WorkerCommand_environment(worker) does this
         shell_template = "export {name}='{value}'"
 
         cmd = []
-        for name, value in [(x, os.environ.get(x)) for x in variables if x in os.environ]:
-            txt = shell_template.format(name=name, value=value)
+        for name, value in sorted(variables.items()):
+            txt = shell_template.format(name=name, value=value.replace("'", "'\\''"))
             cmd.extend([txt, '&&'])
 
         return cmd
@@ -91,6 +122,18 @@ class MyHost(Host):
 
         return mod_load
 
+    def _WorkerCommand_environment_stage(self, worker):
+        """Extract the staged archive on this host, unless it is already there
+            (the first one to get the lock does the actual work, see stage.extract_archive)
+        """
+        stage = []
+        if worker.stage is not None:
+            archive, dest = worker.stage
+            stage.extend(['[', '-d', dest, ']', '||',
+                          worker.pythonExecutable, '-m', self.STAGE_MODULE, archive, dest, '&&'])
+
+        return stage
+
     def _WorkerCommand_bootstrap(self, worker):
         # nice will be passed as argument
         newworker = worker._replace(nice=None)  # worker is namedtuple instance
@@ -108,8 +151,7 @@ class MyHost(Host):
                 c.extend(['--nice', str(worker.nice)])
             if worker.affinity is not None:
                 self.log.debug("WorkerCommand_options affinity %s" % worker.affinity)
-                c.extend(['--affinity',
-                          '{algorithm}:{total_workers_host}:{worker_idx_host}'.format(**worker.affinity)])
+                c.extend(['--affinity', self._WorkerCommand_affinity(worker.affinity)])
         else:
             if worker.nice is not None:
                 self.log.error("nice is set, but no processcontrol")
@@ -117,12 +159,125 @@ class MyHost(Host):
                 self.log.error("affinity is set, but no processcontrol")
 
 
+        if worker.membind is not None:
+            c.extend(['--membind', worker.membind])
+        if worker.environment is not None:
+            c.extend(['--environment', worker.environment])
+        if worker.placement is not None:
+            c.extend(['--placement', worker.placement])
+
         if worker.workerNum == 1 and worker.freeorigin:
             self.log.debug("WorkerCommand_options freeorigin set for worker %s" % worker.workerNum)
             c.append('--freeorigin')
 
         return c
 
+    def _WorkerCommand_affinity(self, affinity):
+        """Return the affinity argument for the bootstrap
+            for the topology and hybrid algorithms, the bootstrap plans the cpus and NUMA node
+            from the topology of the node it runs on
+        """
+        return '{algorithm}:{total_workers_host}:{worker_idx_host}'.format(**affinity)
+
+    def _use_zygote(self):
+        """Start the workers of this host by forking them from a zygote"""
+        return len(self.workersArguments) > 0 and self.workersArguments[0].zygote
+
+    def _getZygoteCommandList(self):
+        """Generate the zygote command as list
+            The bootstrap arguments of all workers are passed (encoded) as a single argument,
+            no shell quoting is needed for them.
+        """
+        worker = self.workersArguments[0]
+
+        workers = []
+        for workerId, launching_args in enumerate(self.workersArguments):
+            argv = [x.strip() for x in self._WorkerCommand_options(launching_args, workerId)]
+            if launching_args.executable:
+                argv.append(launching_args.executable)
+            argv.extend(["%s" % x for x in launching_args.args or []])
+            workers.append(argv)
+
+        c = []
+        if not self.isLocal():
+            c.extend(self._WorkerCommand_environment(worker))
+        c.extend([worker.pythonExecutable, '-m', self.ZYGOTE_MODULE])
+        c.append(encode_workers(worker.executable, ["%s" % x for x in worker.args or []], workers))
+        return c
+
+    def getCommand(self):
+        """The staged archive is extracted once, before any worker of this host is started"""
+        stage = []
+        if len(self.workersArguments) > 0:
+            stage = self._WorkerCommand_environment_stage(self.workersArguments[0])
+
+        self._stage_per_host = len(stage) > 0
+        try:
+            if self._use_zygote():
+                c = ' '.join(self._getZygoteCommandList())
+            else:
+                c = super(MyHost, self).getCommand()
+        finally:
+            self._stage_per_host = False
+
+        return ' '.join(stage + [c])
+
+    def launch(self, *args, **kwargs):
+        if self._use_zygote() and self.isLocal():
+            c = self._getZygoteCommandList()
+            self.log.debug("launch: starting zygote for %s workers on local host %s" %
+                           (len(self.workersArguments), self.hostname))
+            self.subprocesses.append(subprocess.Popen(c))
+            return self.subprocesses
+        else:
+            return super(MyHost, self).launch(*args, **kwargs)
+
+
+class MyCollectiveHost(MyHost):
+    """Host whose workers are not started per host, but together with the workers of all other hosts
+        The collective launch is triggered by the host of the origin worker (which is the last one added)
+    """
+    def __init__(self, *args, **kwargs):
+        super(MyCollectiveHost, self).__init__(*args, **kwargs)
+        self.all_hosts = None
+        self.launch_collective = None
+        self.close_collective = None
+
+    def set_collective(self, all_hosts, launch_collective, close_collective):
+        """Set the list of all hosts and the functions that launch them and clean them up"""
+        self.all_hosts = all_hosts
+        self.launch_collective = launch_collective
+        self.close_collective = close_collective
+
+    def isLocal(self):
+        """All workers are started through a shell by the collective launch"""
+        return False
+
+    def _WorkerCommand_options(self, worker, workerId):
+        c = super(MyCollectiveHost, self)._WorkerCommand_options(worker, workerId)
+        # no process group to report, the collective launch keeps track of the workers (see close_collective)
+        return [x for x in c if x.strip() != '--echoGroup']
+
+    def launch(self, tunnelPorts=None, stdPipe=False):
+        """Nothing is started until the host with the origin worker is launched
+            the last process is the root process, with stdout and stderr piped if stdPipe (as for a remote host)
+        """
+        if any([worker.origin for worker in self.workersArguments]):
+            self.log.debug("launch: origin worker on host %s, starting collective launch" % self.hostname)
+            self.subprocesses.extend(self.launch_collective(self.all_hosts, std_pipe=stdPipe))
+        return self.subprocesses
+
+    def close(self):
+        """Terminate the collective launch processes and clean up the remote workers (if started by this host)"""
+        for process in self.subprocesses:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+
+        if self.subprocesses and self.close_collective is not None:
+            self.close_collective(self.all_hosts)
+
 
 class MyScoopApp(ScoopApp):
     LAUNCH_HOST_CLASS = MyHost
@@ -130,6 +285,12 @@ class MyScoopApp(ScoopApp):
     def __init__(self, *args):
         args = list(args)  # args here is tuple, need to chaneg it (ie remove affintiy arg)
         # remove custom options
+        self.membind = args.pop()
+        self.close_collective = args.pop()
+        self.launch_collective = args.pop()
+        self.environment = args.pop()
+        self.stage = args.pop()
+        self.zygote = args.pop()
         self.load_modules = args.pop()
         self.variables_to_pass = args.pop()
         self.affinity = args.pop()
@@ -137,6 +298,9 @@ class MyScoopApp(ScoopApp):
         self.freeorigin = args.pop()
         super(MyScoopApp, self).__init__(*args)
 
+        if self.launch_collective is not None:
+            self.LAUNCH_HOST_CLASS = MyCollectiveHost
+
     def _addWorker_args(self, workerinfo):
         args, kwargs = super(MyScoopApp, self)._addWorker_args(workerinfo)
         # tuple with lots of info
@@ -144,6 +308,10 @@ class MyScoopApp(ScoopApp):
         affinity = workerinfo.copy()
         affinity['algorithm'] = self.affinity
 
+        # global rank (the origin is the last worker added, it gets rank 0), index on the host and workers on the host
+        kwargs['placement'] = "%s:%s:%s" % (self.workersLeft - 1, workerinfo['worker_idx_host'],
+                                            workerinfo['total_workers_host'])
+
         # this is passed, but nothing is done with it
         kwargs['freeorigin'] = False
         if self.freeorigin:
@@ -170,6 +338,15 @@ class MyScoopApp(ScoopApp):
         kwargs['affinity'] = affinity
         kwargs['variables'] = self.variables_to_pass
         kwargs['load_modules'] = self.load_modules
+        kwargs['zygote'] = self.zygote
+        kwargs['stage'] = self.stage
+        kwargs['environment'] = self.environment
+        # not for the free origin worker, it has no affinity either
+        kwargs['membind'] = (affinity is not None and self.membind) or None
+
+        if self.launch_collective is not None:
+            self.hostsConn[-1].set_collective(self.hostsConn, self.launch_collective, self.close_collective)
+
         return args, kwargs
 
 
@@ -182,8 +359,24 @@ class MYSCOOP(MPI):
     SCOOP_WORKER_MODULE_DEFAULT_NS = 'vsc.mympirun.scoop.worker'
     SCOOP_WORKER_MODULE_DEFAULT = 'simple_shell'
 
+    SCOOP_LAUNCHERS = ['ssh', 'mpi', 'tree']
+    SCOOP_LAUNCHER_DEFAULT = 'ssh'
+    SCOOP_TREE_LAUNCH_MODULE = 'vsc.mympirun.scoop.tree_launch'
+
     PASS_VARIABLES_CLASS_PREFIX = ['SCOOP']  # used for anything?
 
+    # stands in for the command when MPI is initialised without one (simple_shell with a task list of commands)
+    SCOOP_NO_COMMAND = 'scoop_no_command'
+
+    # passed variables that are needed to start the bootstrap, these are exported in the worker command
+    # all other variables are passed through the environment snapshot
+    SCOOP_STARTUP_VARIABLES = ['PATH', 'LD_LIBRARY_PATH', 'PYTHONPATH', 'PYTHONHOME',
+                               'MODULEPATH', 'LOADEDMODULES', 'MODULESHOME']
+    # variables set by the shell that resolves the modules, not by the modules
+    SCOOP_MODULE_IGNORE_VARIABLES = ['_', 'SHLVL', 'PWD', 'OLDPWD']
+    # the module function is set up by (and for) bash
+    SCOOP_MODULE_SHELL = '/bin/bash'
+
     _mpiscriptname_for = ['myscoop']
 
     RUNTIMEOPTION = {'options':{'tunnel':("Activate ssh tunnels to route toward the broker "
@@ -197,22 +390,99 @@ class MYSCOOP(MPI):
                                           "str", "store", SCOOP_WORKER_MODULE_DEFAULT),  # TODO provide list
                                 'profile':("Turn on SCOOP profiling", None, "store_true", False),
                                 'freeorigin':("Run the origin worker as an extra process", None, "store_true", False),
-                                'load-modules': ("List of modules to load in workers", 'strlist', 'store', []),
+                                'affinity': ("Affinity algorithm for the workers (%s: cores and NUMA node per worker "
+                                             "planned on each node from its topology; %s: same, and "
+                                             "export thread count and pinning variables per worker)" %
+                                             (TOPOLOGY_ALGORITHM, HYBRID_ALGORITHM),
+                                             "str", "store", 'basiccore'),
+                                'membind': ("Set the NUMA memory policy of the workers to match their cpu affinity",
+                                            "choice", "store", None, sorted(MEMBIND_MODES.keys())),
+                                'load-modules': ("List of modules to load in workers (resolved once by the launcher)",
+                                                 'strlist', 'store', []),
+                                'launcher': ("Start the workers with one ssh per host, with one collective launch "
+                                             "through the MPI process manager, or with a tree of ssh agents",
+                                             "choice", "store", SCOOP_LAUNCHER_DEFAULT, SCOOP_LAUNCHERS),
+                                'tree-fanout': ("Number of hosts started by each agent with the tree launcher",
+                                                "int", "store", DEFAULT_FANOUT),
+                                'zygote': ("Start one process per host that imports everything once "
+                                           "and forks the workers", None, "store_true", False),
+                                'stage': ("Stage the worker module and its dependencies to node-local scratch",
+                                          None, "store_true", False),
+                                'stage-dir': ("Node-local directory to stage to", "str", "store", '/tmp'),
+                                'log-dir': ("Directory for the per-worker log files (a per-job subdirectory is "
+                                            "used; default /tmp on each node)", "str", "store", None),
+                                'log-debug': ("Log at debug level in the worker modules", None, "store_true", False),
+                                'log-gather': ("Pack the worker logs in scoop_logs_<job>.tar.gz in the current "
+                                               "directory after the run (the log directory must be shared; "
+                                               "default is the mympirun directory)", None, "store_true", False),
+                                'output-dir': ("Write the output of each simple_shell task to a file in a per-job "
+                                               "subdirectory of this (node-local or shared) directory, "
+                                               "instead of returning it through the broker", "str", "store", None),
+                                'output-compress': ("Compress the simple_shell output files",
+                                                    None, "store_true", False),
+                                'output-preview': ("Number of bytes of simple_shell output returned inline "
+                                                   "with --scoop_output-dir", "int", "store", 1024),
+                                'tasks': ("Read the simple_shell tasks from this file (- for stdin of the origin), "
+                                          "one command or set of arguments per line", "str", "store", None),
+                                'chunk': ("Number of simple_shell counters (or task lines) run by one worker call",
+                                          "int", "store", 1),
+                                'concurrency': ("Number of simple_shell commands each worker runs at the same time "
+                                                "(eg for I/O bound commands)", "int", "store", 1),
+                                'journal': ("Append the simple_shell results to this journal and skip the counters "
+                                            "already in it (restart of a killed run)", "str", "store", None),
+                                'timeout': ("Kill simple_shell commands (with their process group) that run "
+                                            "longer than this number of seconds", "float", "store", None),
+                                'speculate': ("Submit the outstanding simple_shell tasks once more when this fraction "
+                                              "of all tasks is done (first result is used)", "float", "store", None),
+                                'accounting': ("Return the resource usage (cpu time, max RSS, I/O) of every "
+                                               "simple_shell command with its result and print a summary per "
+                                               "worker and host", None, "store_true", False),
+                                'cache': ("Cache the successful simple_shell results in this directory",
+                                          "str", "store", None),
+                                'cache-env': ("Environment variables that are part of the cache key",
+                                              "strlist", "store", ['SCOOP_COUNTER']),
+                                'cache-inputs': ("Input files that are part of the cache key (mtime and size)",
+                                                 "strlist", "store", []),
+                                'cache-hash-inputs': ("Use a hash of the content of the input files in the cache key",
+                                                      None, "store_true", False),
+                                'cache-size': ("Maximum size of the cache in MB (least recently used entries "
+                                               "are removed)", "int", "store", 1024),
+                                'results': ("File to write the simple_shell results to as they come in "
+                                            "(- for stdout)", "str", "store", '-'),
+                                'results-format': ("Format of the simple_shell results",
+                                                   "choice", "store", RESULTS_FORMATS[0], RESULTS_FORMATS),
+                                'results-order': ("Order of the simple_shell results (counter order uses "
+                                                  "the outstanding tasks as reorder buffer)",
+                                                  "choice", "store", RESULTS_ORDERS[0], RESULTS_ORDERS),
+                                'results-window': ("Maximum number of outstanding simple_shell tasks",
+                                                   "int", "store", RESULTS_WINDOW),
                                 },
                      'prefix':'scoop',
                      'description': ('SCOOP options', 'Advanced options specific for SCOOP'),
                      }
 
     def __init__(self, options, cmdargs, **kwargs):
+        # MPI refuses an empty command, the task list provides the commands
+        no_command = not cmdargs and getattr(options, 'scoop_tasks', None) is not None
+        if no_command:
+            cmdargs = [self.SCOOP_NO_COMMAND]
+
         super(MYSCOOP, self).__init__(options, cmdargs, **kwargs)
 
+        if no_command:
+            self.cmdargs = []
+
         # all SCOOP options are ready can be added on command line ? (add them to RUNTIMEOPTION)
         # TODO : actually decide on wether they are options or not and
         #   and change most of the code form self.scoop_X to self.options.scoop_X
         #  (except for executable and args)
 
         allargs = self.cmdargs[:]
-        exe = allargs.pop(0)
+        if allargs:
+            exe = allargs.pop(0)
+        else:
+            # eg simple_shell with a task list of commands
+            exe = ''
 
         self.scoop_size = getattr(self.options, 'scoop_size', None)
         self.scoop_hosts = getattr(self.options, 'scoop_hosts', None)
@@ -227,6 +497,8 @@ class MYSCOOP(MPI):
         self.scoop_nice = getattr(self.options, 'scoop_nice', 0)
         self.scoop_affinity = getattr(self.options, 'scoop_affinity', 'basiccore')  # the algorithm
 
+        self.scoop_membind = getattr(self.options, 'scoop_membind', None)
+
         self.scoop_path = getattr(self.options, 'scoop_path', os.getcwd())
 
         # default broker is first of unique nodes ?
@@ -251,6 +523,50 @@ class MYSCOOP(MPI):
 
         self.scoop_profile = getattr(self.options, 'scoop_profile', False)
 
+        self.scoop_launcher = getattr(self.options, 'scoop_launcher', self.SCOOP_LAUNCHER_DEFAULT)
+        if self.scoop_launcher not in self.SCOOP_LAUNCHERS:
+            self.log.raiseException("Unknown scoop_launcher %s (supported %s)" %
+                                    (self.scoop_launcher, self.SCOOP_LAUNCHERS))
+        self.scoop_tree_fanout = getattr(self.options, 'scoop_tree_fanout', DEFAULT_FANOUT)
+
+        self.scoop_zygote = getattr(self.options, 'scoop_zygote', False)
+        if self.scoop_zygote and self.scoop_launcher == 'mpi':
+            self.log.warning("scoop_zygote is not supported with the mpi launcher (one rank per worker), ignoring it")
+            self.scoop_zygote = False
+
+        self.scoop_stage = getattr(self.options, 'scoop_stage', False)
+        self.scoop_stage_dir = getattr(self.options, 'scoop_stage_dir', '/tmp')
+        self.scoop_staged = None  # (archive, destination) once staged
+
+        if self.scoop_tunnel and not self.scoop_launcher == 'ssh':
+            self.log.warning("scoop_tunnel is only supported with the ssh launcher, ignoring it")
+            self.scoop_tunnel = False
+
+        self.scoop_output_dir = getattr(self.options, 'scoop_output_dir', None)
+        self.scoop_output_compress = getattr(self.options, 'scoop_output_compress', False)
+        self.scoop_output_preview = getattr(self.options, 'scoop_output_preview', 1024)
+
+        self.scoop_log_dir = getattr(self.options, 'scoop_log_dir', None)
+        self.scoop_log_debug = getattr(self.options, 'scoop_log_debug', False)
+        self.scoop_log_gather = getattr(self.options, 'scoop_log_gather', False)
+
+        self.scoop_tasks = getattr(self.options, 'scoop_tasks', None)
+        self.scoop_chunk = getattr(self.options, 'scoop_chunk', 1)
+        self.scoop_concurrency = getattr(self.options, 'scoop_concurrency', 1)
+        self.scoop_journal = getattr(self.options, 'scoop_journal', None)
+        self.scoop_timeout = getattr(self.options, 'scoop_timeout', None)
+        self.scoop_speculate = getattr(self.options, 'scoop_speculate', None)
+        self.scoop_accounting = getattr(self.options, 'scoop_accounting', False)
+        self.scoop_cache = getattr(self.options, 'scoop_cache', None)
+        self.scoop_cache_env = getattr(self.options, 'scoop_cache_env', ['SCOOP_COUNTER'])
+        self.scoop_cache_inputs = getattr(self.options, 'scoop_cache_inputs', [])
+        self.scoop_cache_hash_inputs = getattr(self.options, 'scoop_cache_hash_inputs', False)
+        self.scoop_cache_size = getattr(self.options, 'scoop_cache_size', 1024)
+        self.scoop_results = getattr(self.options, 'scoop_results', '-')
+        self.scoop_results_format = getattr(self.options, 'scoop_results_format', RESULTS_FORMATS[0])
+        self.scoop_results_order = getattr(self.options, 'scoop_results_order', RESULTS_ORDERS[0])
+        self.scoop_results_window = getattr(self.options, 'scoop_results_window', RESULTS_WINDOW)
+
         self.scoop_remote = {}
         self.scoop_workers_free = None
 
@@ -260,6 +576,8 @@ class MYSCOOP(MPI):
 
         self.scoop_prepare()
         self.scoop_make_executable()
+        if self.scoop_stage:
+            self.scoop_stage_executable()
 
         self.scoop_run()
 
@@ -288,7 +606,8 @@ class MYSCOOP(MPI):
             return module_fn
 
         if not self.scoop_executable.endswith('.py'):
-            self.scoop_args = [self.scoop_executable] + self.scoop_args
+            if self.scoop_executable:
+                self.scoop_args = [self.scoop_executable] + self.scoop_args
 
             module_fn = _get_module(self.scoop_module)
             if module_fn is None:
@@ -303,6 +622,67 @@ class MYSCOOP(MPI):
             self.log.debug("scoop_make_executable: from scoop_module %s executable %s args %s" % (
                             self.scoop_module, self.scoop_executable, self.scoop_args))
 
+    def scoop_stage_executable(self):
+        """Pack the executable, its dependencies and bytecode in one archive in the mympirundir
+            Each node extracts it once to the node-local stage directory,
+            the executable and PYTHONPATH point to the staged copy.
+        """
+        archive = os.path.join(self.mympirundir, 'scoop_stage.tar.gz')
+        dest = os.path.join(self.scoop_stage_dir, 'scoop_stage_%s' % os.path.basename(self.mympirundir))
+
+        modules = [MyHost.BOOTSTRAP_MODULE, MyHost.ZYGOTE_MODULE]
+        nr_files = make_archive(archive, self.scoop_executable, modules=modules)
+        self.log.debug("scoop_stage_executable: archive %s with %s files for executable %s" %
+                       (archive, nr_files, self.scoop_executable))
+
+        # the local workers are started from the launcher environment
+        extract_archive(archive, dest)
+        pythonpath = [dest] + [x for x in os.environ.get('PYTHONPATH', '').split(os.pathsep) if x]
+        os.environ['PYTHONPATH'] = os.pathsep.join(pythonpath)
+
+        self.scoop_pythonpath = [os.environ['PYTHONPATH']]
+        self.scoop_executable = os.path.join(dest, os.path.basename(self.scoop_executable))
+        self.scoop_staged = (archive, dest)
+        self.log.debug("scoop_stage_executable: staged to %s, executable %s" % (dest, self.scoop_executable))
+
+    def cleanup(self):
+        """Also remove the staged copies (and gather the worker logs)"""
+        if self.scoop_log_gather:
+            self.scoop_gather_logs()
+
+        if self.scoop_staged is not None:
+            dest = self.scoop_staged[1]
+            try:
+                shutil.rmtree(dest)
+                self.log.debug("cleanup: removed staged %s" % dest)
+            except OSError:
+                self.log.error("cleanup: failed to remove staged %s" % dest)
+            self.scoop_cleanup_remote_staged(dest)
+
+        super(MYSCOOP, self).cleanup()
+
+    def scoop_cleanup_remote_staged(self, dest):
+        """Remove the staged copy dest on all remote hosts (in parallel, over ssh)"""
+        hostnames = []
+        for hostname in self.scoop_hosts or []:
+            if not hostname in hostnames and not hostname in utils.localHostnames:
+                hostnames.append(hostname)
+
+        processes = []
+        for hostname in hostnames:
+            cmd = MyHost.BASE_SSH + [hostname, 'rm -rf %s' % dest]
+            try:
+                processes.append((hostname, subprocess.Popen(cmd)))
+            except OSError:
+                self.log.error("scoop_cleanup_remote_staged: failed to start %s" % cmd)
+
+        for hostname, process in processes:
+            ec = process.wait()
+            if ec > 0:
+                self.log.error("scoop_cleanup_remote_staged: failed to remove staged %s on host %s (ec %s)" %
+                               (dest, hostname, ec))
+        self.log.debug("scoop_cleanup_remote_staged: removed staged %s on %s hosts" % (dest, len(processes)))
+
     def scoop_prepare(self):
         """Prepare the scoop parameters and commands"""
         # self.mpinodes is the node list to use
@@ -323,9 +703,292 @@ class MYSCOOP(MPI):
         if self.scoop_infobroker is None:
             self.scoop_infobroker = self.scoop_broker
 
+    def scoop_popen(self, cmd, std_pipe=False, **kwargs):
+        """Start cmd, with stdout and stderr piped if std_pipe
+            (the root process of a host that is not local is read by ScoopApp.run through the pipes)
+        """
+        if std_pipe:
+            kwargs['stdout'] = subprocess.PIPE
+            kwargs['stderr'] = subprocess.PIPE
+        return subprocess.Popen(cmd, **kwargs)
+
+    def scoop_launch_collective(self, hosts, std_pipe=False):
+        """Start the workers of all hosts at once
+            returns the list of started processes, the last one is the one to wait for
+            (with stdout and stderr piped if std_pipe)
+        """
+        if self.scoop_launcher == 'mpi':
+            return self.scoop_launch_mpi(hosts, std_pipe=std_pipe)
+        elif self.scoop_launcher == 'tree':
+            return self.scoop_launch_tree(hosts, std_pipe=std_pipe)
+        else:
+            self.log.raiseException("scoop_launch_collective: no collective launch for launcher %s" %
+                                    self.scoop_launcher)
+
+    def scoop_close_collective(self, hosts):
+        """Clean up the workers of the collective launch, after the launch processes are terminated
+            (mpirun cleans up its own ranks)
+        """
+        if self.scoop_launcher == 'tree':
+            self.scoop_kill_tree(hosts)
+
+    def scoop_make_mpi_commands(self, hosts):
+        """Write the commands file with the command of every worker (one per rank)
+            returns the commands filename and the list of nodes (one per rank)
+        """
+        nodes = []
+        commands = []
+        for host in hosts:
+            for worker_id in range(len(host.workersArguments)):
+                nodes.append(host.hostname)
+                commands.append(host.getWorkerCommand(worker_id))
+
+        commands_fn = os.path.join(self.mympirundir, 'scoop_commands')
+        write_commands(commands_fn, commands)
+        self.log.debug("scoop_make_mpi_commands: wrote %s commands for %s hosts in %s" %
+                       (len(commands), len(hosts), commands_fn))
+
+        return commands_fn, nodes
+
+    def scoop_launch_mpi(self, hosts, std_pipe=False):
+        """Start every worker as a rank of a single MPI launch
+            The remote processes are started by whatever the MPI flavour uses for a regular mpirun
+            (hydra bootstrap, PBS TM interface, ...)
+        """
+        commands_fn, nodes = self.scoop_make_mpi_commands(hosts)
+
+        # ranks are placed in machinefile order, one per line
+        self.make_machine_file(nodetxt="\n".join(nodes))
+
+        self.make_mpdboot()
+        self.set_mpiexec_global_options()
+        self.set_mpiexec_opts_from_env()
+        self.set_mpiexec_options()
+
+        # one rank per worker, not per core (eg freeorigin adds one)
+        self.mpiexec_options = [x for x in self.mpiexec_options if not x.startswith('-np ')]
+        self.mpiexec_options.append("-np %s" % len(nodes))
+
+        # the shell trampoline of every rank is added here, quoted once for the shell that starts mpirun
+        # (make_mpirun quotes the cmdargs itself in some versions, which would quote it twice)
+        self.cmdargs = []
+        self.make_mpirun()
+        self.mpirun_cmd.extend([pipes.quote(x) for x in get_launch_command(commands_fn)])
+
+        cmd = ' '.join([x for x in self.mpirun_cmd if x])
+        self.log.debug("scoop_launch_mpi: going to start %s" % cmd)
+        return [self.scoop_popen(cmd, std_pipe=std_pipe, shell=True)]
+
+    def scoop_get_tree_spec_filename(self):
+        """Return the name of the spec file of the tree launcher"""
+        return os.path.join(self.mympirundir, 'scoop_tree.json')
+
+    def scoop_make_tree_spec(self, hosts):
+        """Write the spec file for the agents of all hosts, the last one (with the origin worker) is node 0
+            returns the spec
+        """
+        origin_host = hosts[-1]
+        tree_hosts = [[host.hostname, host.getCommand()] for host in hosts[:-1]]
+
+        # the agents need the same environment as the workers to find the tree_launch module
+        prolog = ' '.join(origin_host._WorkerCommand_environment(origin_host.workersArguments[0]))
+        spec_fn = self.scoop_get_tree_spec_filename()
+        agent = ' '.join([prolog.replace('%', '%%'), self.scoop_python, '-m', self.SCOOP_TREE_LAUNCH_MODULE,
+                          spec_fn, '%(node)s'])
+        return write_spec(spec_fn, tree_hosts, [origin_host.hostname, origin_host.getCommand()],
+                          self.scoop_tree_fanout, MyHost.BASE_SSH, agent)
+
+    def scoop_popen_origin_agent(self, spec, kill=False, std_pipe=False):
+        """Start the agent of the host with the origin worker (node 0, it starts no children)"""
+        hostname = spec['origin'][0]
+        cmd = get_agent_command(spec, 0, kill=kill)
+        if hostname in utils.localHostnames:
+            shell = os.environ.get('SHELL', '/bin/sh')
+            return self.scoop_popen(cmd, std_pipe=std_pipe, shell=True, executable=shell)
+        else:
+            return self.scoop_popen(MyHost.BASE_SSH + [hostname, cmd], std_pipe=std_pipe)
+
+    def scoop_launch_tree(self, hosts, std_pipe=False):
+        """Start the workers through a tree of per-host agents (see tree_launch)
+            The agent of the host with the origin worker is started directly by the launcher (the root process).
+        """
+        spec = self.scoop_make_tree_spec(hosts)
+        tree_hosts = spec['hosts']
+
+        self.log.debug("scoop_launch_tree: starting %s agents for %s hosts (fanout %s)" %
+                       (len(get_children(0, self.scoop_tree_fanout, len(tree_hosts))), len(tree_hosts),
+                        self.scoop_tree_fanout))
+        processes = start_children(spec, 0)
+        processes.append(self.scoop_popen_origin_agent(spec, std_pipe=std_pipe))
+
+        return processes
+
+    def scoop_kill_tree(self, hosts):
+        """Kill the process groups of all agents (with their workers) through a tree of agents in kill mode
+            terminating the ssh processes that started the remote agents does not stop them
+        """
+        spec_fn = self.scoop_get_tree_spec_filename()
+        if not os.path.isfile(spec_fn):
+            self.log.debug("scoop_kill_tree: no spec file %s, nothing was started" % spec_fn)
+            return
+
+        spec = read_spec(spec_fn)
+        self.log.debug("scoop_kill_tree: killing the agents of %s hosts" % (len(spec['hosts']) + 1))
+        processes = start_children(spec, 0, kill=True)
+        processes.append(self.scoop_popen_origin_agent(spec, kill=True))
+        for process in processes:
+            process.wait()
+
+    def scoop_resolve_modules(self):
+        """Load the modules once on the launcher and return the resulting environment changes
+            returns dict name: value (None for removed variables), or None if the modules can't be loaded
+        """
+        marker = '__SCOOP_MODULE_ENVIRONMENT__'
+        dump = "import json, os, sys; sys.stdout.write(\"%s\" + json.dumps(dict(os.environ)))" % marker
+        # no subshell: the module function has to be defined in the shell that loads the modules
+        script = ' '.join(["{ type module || . $MODULESHOME/init/bash; } >/dev/null 2>&1 &&",
+                           'module', 'load'] + self.scoop_load_modules +
+                          ['>/dev/null 2>&1', '&&', self.scoop_python, '-c', "'%s'" % dump])
+        cmd = ' '.join([self.SCOOP_MODULE_SHELL, '-c', pipes.quote(script)])
+
+        ec, out = run_simple(cmd)
+        if ec > 0 or not marker in out:
+            self.log.warning("scoop_resolve_modules: failed to load modules %s with %s (ec %s out %s)" %
+                             (self.scoop_load_modules, cmd, ec, out))
+            return None
+
+        loaded = json.loads(out.split(marker, 1)[1])
+        delta = dict([(k, v) for k, v in loaded.items()
+                      if not k in self.SCOOP_MODULE_IGNORE_VARIABLES and os.environ.get(k) != v])
+        delta.update(dict([(k, None) for k in os.environ
+                           if not k in self.SCOOP_MODULE_IGNORE_VARIABLES and not k in loaded]))
+        self.log.debug("scoop_resolve_modules: modules %s change variables %s" %
+                       (self.scoop_load_modules, sorted(delta.keys())))
+        return delta
+
+    def scoop_get_log_dir(self):
+        """Return the directory of the worker logs of this job, None for the default"""
+        if self.scoop_log_dir is not None:
+            return os.path.join(self.scoop_log_dir, 'scoop_logs_%s' % os.path.basename(self.mympirundir))
+        elif self.scoop_log_gather:
+            return os.path.join(self.mympirundir, 'scoop_logs')
+        return None
+
+    def scoop_gather_logs(self):
+        """Pack the worker logs of this job in one compressed archive in the current directory"""
+        log_dir = self.scoop_get_log_dir()
+        if not os.path.isdir(log_dir):
+            self.log.warning("scoop_gather_logs: no log directory %s" % log_dir)
+            return
+
+        name = 'scoop_logs_%s' % os.path.basename(self.mympirundir)
+        archive = os.path.abspath('%s.tar.gz' % name)
+        tar = tarfile.open(archive, 'w:gz')
+        tar.add(log_dir, arcname=name)
+        tar.close()
+        shutil.rmtree(log_dir)
+        self.log.info("scoop_gather_logs: worker logs of %s in %s" % (log_dir, archive))
+
+    def scoop_set_worker_variables(self):
+        """Set the SCOOP variables for the worker modules (passed with the environment snapshot)
+            the simple_shell options are only set when they are used (not the default)
+        """
+        log_dir = self.scoop_get_log_dir()
+        if log_dir is not None:
+            set_scoop_env('log_dir', log_dir)
+        if self.scoop_log_debug:
+            set_scoop_env('log_debug', 1)
+
+        if self.scoop_output_dir is not None:
+            output_dir = os.path.join(self.scoop_output_dir, 'scoop_output_%s' % os.path.basename(self.mympirundir))
+            self.log.info("scoop_set_worker_variables: simple_shell output in %s (on each node)" % output_dir)
+            set_scoop_env('output_dir', output_dir)
+            set_scoop_env('output_compress', int(self.scoop_output_compress))
+            set_scoop_env('output_preview', self.scoop_output_preview)
+
+        if self.scoop_tasks is not None:
+            tasks = self.scoop_tasks
+            if tasks != '-':
+                tasks = os.path.abspath(tasks)
+            set_scoop_env('tasks', tasks)
+
+        if self.scoop_journal is not None:
+            set_scoop_env('journal', os.path.abspath(self.scoop_journal))
+
+        if self.scoop_timeout is not None:
+            set_scoop_env('timeout', self.scoop_timeout)
+        if self.scoop_speculate is not None:
+            set_scoop_env('speculate', self.scoop_speculate)
+
+        if self.scoop_accounting:
+            set_scoop_env('accounting', 1)
+
+        if self.scoop_cache is not None:
+            set_scoop_env('cache', os.path.abspath(self.scoop_cache))
+            set_scoop_env('cache_env', ','.join(self.scoop_cache_env))
+            set_scoop_env('cache_inputs', ','.join([os.path.abspath(x) for x in self.scoop_cache_inputs]))
+            set_scoop_env('cache_hash_inputs', int(self.scoop_cache_hash_inputs))
+            set_scoop_env('cache_size', self.scoop_cache_size)
+
+        self.scoop_set_worker_option('chunk', self.scoop_chunk)
+        self.scoop_set_worker_option('concurrency', self.scoop_concurrency)
+
+        results = self.scoop_results
+        if results != '-':
+            results = os.path.abspath(results)
+        self.scoop_set_worker_option('results', results)
+        self.scoop_set_worker_option('results_format', self.scoop_results_format)
+        self.scoop_set_worker_option('results_order', self.scoop_results_order)
+        self.scoop_set_worker_option('results_window', self.scoop_results_window)
+
+    def scoop_set_worker_option(self, name, value):
+        """Set the SCOOP variable of a (simple_shell) option, only if it is not the default of the option
+            (the worker modules use the same default when it is not set)
+        """
+        default = self.RUNTIMEOPTION['options'][name.replace('_', '-')][3]
+        if value != default:
+            set_scoop_env(name, value)
+
+    def scoop_make_environment(self):
+        """Write the environment snapshot with the passed variables and the resolved modules
+            returns snapshot filename, dict with variables to export and list of modules that workers still load
+        """
+        self.scoop_set_worker_variables()
+
+        environment = dict([(x, os.environ[x]) for x in self.get_pass_variables() if x in os.environ])
+        scoop_prefix = SCOOP_ENVIRONMENT_PREFIX + SCOOP_ENVIRONMENT_SEPARATOR
+        environment.update(dict([(k, v) for k, v in os.environ.items() if k.startswith(scoop_prefix)]))
+
+        load_modules = self.scoop_load_modules
+        if load_modules:
+            delta = self.scoop_resolve_modules()
+            if delta is None:
+                self.log.warning("scoop_make_environment: modules %s not resolved, every worker loads them" %
+                                 load_modules)
+            else:
+                environment.update(delta)
+                load_modules = []
+
+        environment_fn = os.path.join(self.mympirundir, 'scoop_environment.json.gz')
+        write_environment(environment_fn, environment)
+
+        vars_to_export = dict([(k, v) for k, v in environment.items()
+                               if k in self.SCOOP_STARTUP_VARIABLES and v is not None])
+        self.log.debug("scoop_make_environment: wrote %s variables in environment snapshot %s, exporting %s" %
+                       (len(environment), environment_fn, sorted(vars_to_export.keys())))
+
+        return environment_fn, vars_to_export, load_modules
+
     def scoop_run(self):
         """Run the launcher"""
-        vars_to_pass = self.get_pass_variables()
+        environment_fn, vars_to_export, load_modules = self.scoop_make_environment()
+
+        if self.scoop_launcher == 'ssh':
+            launch_collective = None
+            close_collective = None
+        else:
+            launch_collective = self.scoop_launch_collective
+            close_collective = self.scoop_close_collective
         # add uniquenodes that are localhost
         localhosts = self.get_localhosts()
         utils.localHostnames.extend([hn for hn, ip in localhosts if not hn in utils.localHostnames])
@@ -356,8 +1019,14 @@ class MYSCOOP(MPI):
                           self.scoop_freeorigin,
                           self.scoop_processcontrol,
                           self.scoop_affinity,
-                          vars_to_pass,
-                          self.scoop_load_modules,
+                          vars_to_export,
+                          load_modules,
+                          self.scoop_zygote,
+                          self.scoop_staged,
+                          environment_fn,
+                          launch_collective,
+                          close_collective,
+                          self.scoop_membind,
                           ]
         self.log.debug("scoop_run: scoop_app class %s args %s" % (self.SCOOP_APP.__name__, scoop_app_args))
 
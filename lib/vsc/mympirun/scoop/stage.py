@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Stage the worker module and its dependencies to node-local scratch
+
+The launcher packs the executable, all non-standard-library modules it (and the bootstrap) imports
+and their bytecode in one archive on the shared filesystem.
+It is extracted once per node to the node-local directory, in front of the host command
+(or by the first worker of the node to get the lock, the other ones wait for it).
+The staged directory is put in front of the PYTHONPATH of the workers.
+"""
+import os
+import py_compile
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from distutils import sysconfig
+from modulefinder import ModuleFinder
+
+LOCK_SUFFIX = '.lock'
+WAIT_INTERVAL = 0.2
+WAIT_TIMEOUT = 600
+
+EXTENSION_SUFFIX_REGEXP = re.compile(r'\.(so|pyd)$')
+
+
+def _find_path_entry(filename, path):
+    """Return the path entry filename was found in (the longest matching one)"""
+    entries = [entry for entry in path if entry and filename.startswith(os.path.join(entry, ''))]
+    if entries:
+        return max(entries, key=len)
+    return None
+
+
+def get_dependencies(executable, modules=None, path=None):
+    """Return list of (filename, name in archive) for executable and all its non-stdlib dependencies
+        modules is a list of module names that are added as well (with their dependencies)
+        Packages with extension modules are added as a whole directory (they might carry shared libraries).
+    """
+    if path is None:
+        path = sys.path[:]
+    path = [os.path.dirname(os.path.abspath(executable))] + [os.path.abspath(x) for x in path if x]
+
+    stdlib = os.path.join(os.path.abspath(sysconfig.get_python_lib(standard_lib=True)), '')
+    sitelibs = [os.path.join(os.path.abspath(x), '') for x in (sysconfig.get_python_lib(),
+                                                               sysconfig.get_python_lib(plat_specific=True))]
+
+    finder = ModuleFinder(path=path)
+    finder.run_script(executable)
+    for name in modules or []:
+        finder.import_hook(name)
+
+    files = []
+    packagedirs = {}
+    for module in finder.modules.values():
+        filename = module.__file__
+        if filename is None:
+            # builtin
+            continue
+        filename = os.path.abspath(filename)
+        if filename.startswith(stdlib) and not any([filename.startswith(x) for x in sitelibs]):
+            continue
+        entry = _find_path_entry(filename, path)
+        if entry is None:
+            continue
+        arcname = os.path.relpath(filename, entry)
+        if EXTENSION_SUFFIX_REGEXP.search(filename) and os.sep in arcname:
+            toplevel = arcname.split(os.sep)[0]
+            packagedirs[toplevel] = os.path.join(entry, toplevel)
+        else:
+            files.append((filename, arcname))
+
+    res = [(os.path.abspath(executable), os.path.basename(executable))]
+    res.extend([(filename, arcname) for filename, arcname in files if arcname.split(os.sep)[0] not in packagedirs])
+    res.extend([(dirname, toplevel) for toplevel, dirname in packagedirs.items()])
+    return res
+
+
+def make_archive(archive, executable, modules=None, path=None):
+    """Create the archive with executable, its dependencies and their bytecode
+        returns the number of files and directories added
+    """
+    tmpdir = tempfile.mkdtemp()
+    tar = tarfile.open(archive, 'w:gz')
+    nr_files = 0
+    seen = set()
+    for filename, arcname in get_dependencies(executable, modules=modules, path=path):
+        if arcname in seen:
+            continue
+        seen.add(arcname)
+        tar.add(filename, arcname=arcname)
+        nr_files += 1
+        if os.path.isdir(filename):
+            # bytecode of packages with extension modules is not added
+            continue
+        if filename.endswith('.py'):
+            cfile = os.path.join(tmpdir, 'compiled.pyc')
+            try:
+                py_compile.compile(filename, cfile=cfile, doraise=True)
+            except py_compile.PyCompileError:
+                continue
+            tar.add(cfile, arcname=arcname + 'c')
+            nr_files += 1
+    tar.close()
+    shutil.rmtree(tmpdir)
+    return nr_files
+
+
+def extract_archive(archive, dest):
+    """Extract the archive to dest, once per node
+        The first process to get the lock extracts in a temporary directory and renames it to dest,
+        the other ones wait until dest exists.
+        returns True if this process extracted the archive
+    """
+    if os.path.isdir(dest):
+        return False
+
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    lock = dest + LOCK_SUFFIX
+    try:
+        os.mkdir(lock)
+    except OSError:
+        waited = 0
+        while not os.path.isdir(dest):
+            if waited > WAIT_TIMEOUT:
+                raise Exception("extract_archive: timeout waiting for %s (lock %s)" % (dest, lock))
+            time.sleep(WAIT_INTERVAL)
+            waited += WAIT_INTERVAL
+        return False
+
+    try:
+        if os.path.isdir(dest):
+            # extracted by another process in the meantime
+            return False
+        tmpdest = tempfile.mkdtemp(prefix=os.path.basename(dest), dir=parent)
+        tar = tarfile.open(archive, 'r:gz')
+        tar.extractall(tmpdest)
+        tar.close()
+        os.chmod(tmpdest, 0o755)
+        os.rename(tmpdest, dest)
+    finally:
+        os.rmdir(lock)
+    return True
+
+
+def main():
+    """Extract the archive on this node"""
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: %s <archive> <destination>\n" % sys.argv[0])
+        sys.exit(1)
+
+    extract_archive(sys.argv[1], sys.argv[2])
+
+if __name__ == '__main__':
+    main()
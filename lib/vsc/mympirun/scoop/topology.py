@@ -0,0 +1,246 @@
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Node topology (cpus, cores, NUMA nodes, L3 cache domains) from /sys
+and the placement of workers on it
+
+The placement is computed on each node, from the topology and cpuset of that node
+(the bootstrap of each worker plans its own cpus and NUMA node, the zygote reads the topology once per node).
+"""
+import glob
+import os
+import re
+
+SYS_CPU = '/sys/devices/system/cpu'
+SYS_NODE = '/sys/devices/system/node'
+PROC_STATUS = '/proc/self/status'
+PROC_CPUSET = '/proc/self/cpuset'
+SYS_CGROUP = '/sys/fs/cgroup'
+
+TOPOLOGY_ALGORITHM = 'topology'
+# as topology, and the worker exports thread count and pinning variables for its block of cores
+HYBRID_ALGORITHM = 'hybrid'
+PLANNED_ALGORITHMS = [TOPOLOGY_ALGORITHM, HYBRID_ALGORITHM]
+
+_topology = None
+
+
+def parse_cpulist(txt):
+    """Convert cpulist format (eg 0-3,8,10-11) in list of ints"""
+    cpus = []
+    for rng in txt.strip().split(','):
+        if not rng:
+            continue
+        indices = [int(x) for x in rng.split('-')]
+        cpus.extend(range(indices[0], indices[-1] + 1))
+    return cpus
+
+
+def make_cpulist(cpus):
+    """Convert list of ints into cpulist format"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] + 1 == cpu:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join([(start == end and "%s" % start) or "%s-%s" % (start, end) for start, end in ranges])
+
+
+def read_file(filename, default=None):
+    """Return stripped content of filename, or default if it can't be read"""
+    try:
+        fh = open(filename)
+        txt = fh.read().strip()
+        fh.close()
+    except (IOError, OSError):
+        txt = default
+    return txt
+
+
+def _split_evenly(items, nr_parts):
+    """Split items in nr_parts contiguous parts, with sizes that differ at most by one"""
+    parts = []
+    start = 0
+    for idx in range(nr_parts):
+        end = start + len(items) // nr_parts + int(idx < len(items) % nr_parts)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+
+class Topology(object):
+    """Topology of the node, restricted to the cpus this process is allowed to use"""
+
+    def __init__(self, cpus, core_of, numa_of, l3_of):
+        """
+            cpus: list of usable cpus
+            core_of, numa_of, l3_of: dict cpu -> (package, core), NUMA node and L3 cache domain key
+        """
+        self.cpus = sorted(cpus)
+        self.core_of = core_of
+        self.numa_of = numa_of
+        self.l3_of = l3_of
+        self._plans = {}
+
+        # physical cores, each a list of its hardware threads, ordered by NUMA node, L3 domain and cpu
+        cores = {}
+        for cpu in self.cpus:
+            cores.setdefault(self.core_of[cpu], []).append(cpu)
+        self.cores = sorted(cores.values(), key=lambda threads: (self.numa_of[threads[0]], self.l3_of[threads[0]],
+                                                                 threads[0]))
+
+        self.numa_nodes = sorted(set([self.numa_of[cpu] for cpu in self.cpus]))
+
+    @classmethod
+    def from_sys(cls, sys_cpu=SYS_CPU, sys_node=SYS_NODE, proc_status=PROC_STATUS):
+        """Read the topology from /sys, returns None if it can't be determined"""
+        online = read_file(os.path.join(sys_cpu, 'online'))
+        if online is None:
+            return None
+        cpus = parse_cpulist(online)
+
+        # restrict to the cpuset of the job
+        status = read_file(proc_status, '')
+        regex = re.search(r'^Cpus_allowed_list:\s*(\S+)', status, re.M)
+        if regex:
+            allowed = set(parse_cpulist(regex.group(1)))
+            cpus = [cpu for cpu in cpus if cpu in allowed]
+
+        core_of = {}
+        l3_of = {}
+        for cpu in cpus:
+            cpudir = os.path.join(sys_cpu, 'cpu%s' % cpu)
+            package = read_file(os.path.join(cpudir, 'topology', 'physical_package_id'), '0')
+            core = read_file(os.path.join(cpudir, 'topology', 'core_id'), "%s" % cpu)
+            core_of[cpu] = (int(package), int(core))
+
+            l3_of[cpu] = package
+            for cache in glob.glob(os.path.join(cpudir, 'cache', 'index*')):
+                if read_file(os.path.join(cache, 'level')) == '3':
+                    l3_of[cpu] = read_file(os.path.join(cache, 'shared_cpu_list'), package)
+
+        numa_of = dict([(cpu, 0) for cpu in cpus])
+        for nodedir in glob.glob(os.path.join(sys_node, 'node[0-9]*')):
+            node = int(os.path.basename(nodedir)[len('node'):])
+            for cpu in parse_cpulist(read_file(os.path.join(nodedir, 'cpulist'), '')):
+                if cpu in numa_of:
+                    numa_of[cpu] = node
+
+        if not cpus:
+            return None
+        return cls(cpus, core_of, numa_of, l3_of)
+
+    def plan(self, nr_workers):
+        """Return list with (cpus, NUMA node) for each worker
+            With at most one worker per core, the workers are spread over the NUMA nodes
+            (proportional to the number of cores in each node) and get a contiguous block of whole cores
+            (including their SMT siblings) within that node, so workers never share a core.
+            With more workers than cores, each worker gets (a share of) single hardware threads.
+        """
+        if nr_workers in self._plans:
+            return self._plans[nr_workers]
+
+        if nr_workers <= len(self.cores):
+            blocks = []
+            node_cores = [[core for core in self.cores if self.numa_of[core[0]] == node] for node in self.numa_nodes]
+            for cores, nr_node_workers in zip(node_cores, self._workers_per_node(nr_workers, node_cores)):
+                for block in _split_evenly(cores, nr_node_workers):
+                    blocks.append(sum(block, []))
+        else:
+            # first thread of every core, then the second ones, ...
+            max_threads = max([len(core) for core in self.cores])
+            threads = [core[idx] for idx in range(max_threads) for core in self.cores if idx < len(core)]
+            threads.sort(key=lambda cpu: (self.numa_of[cpu], self.l3_of[cpu]))
+            if nr_workers <= len(threads):
+                blocks = _split_evenly(threads, nr_workers)
+            else:
+                blocks = [[threads[idx % len(threads)]] for idx in range(nr_workers)]
+
+        plan = [(sorted(cpus), self.numa_of[cpus[0]]) for cpus in blocks]
+        self._plans[nr_workers] = plan
+        return plan
+
+    def nr_cores(self, cpus):
+        """Number of physical cores the cpus belong to"""
+        return len(set([self.core_of[cpu] for cpu in cpus]))
+
+    def _workers_per_node(self, nr_workers, node_cores):
+        """Number of workers per NUMA node, proportional to the number of cores (largest remainder)"""
+        total = sum([len(cores) for cores in node_cores])
+        shares = [1.0 * nr_workers * len(cores) / total for cores in node_cores]
+        counts = [int(share) for share in shares]
+        remainders = sorted(range(len(shares)), key=lambda idx: counts[idx] - shares[idx])
+        for idx in remainders[:nr_workers - sum(counts)]:
+            counts[idx] += 1
+        return counts
+
+
+def get_cpuset_cpus(proc_cpuset=PROC_CPUSET, sys_cgroup=SYS_CGROUP):
+    """Return the cpus of the cpuset cgroup of this process (eg the job), None if unknown
+        unlike Cpus_allowed_list, this is not restricted by the affinity of the process
+    """
+    path = read_file(proc_cpuset)
+    if path is None:
+        return None
+    path = path.lstrip('/')
+    # cgroup v1, v2
+    for filename in [os.path.join(sys_cgroup, 'cpuset', path, 'cpuset.cpus'),
+                     os.path.join(sys_cgroup, path, 'cpuset.cpus.effective')]:
+        txt = read_file(filename)
+        if txt:
+            return parse_cpulist(txt)
+    return None
+
+
+def get_host_topology():
+    """Return the topology of all cpus of the cpuset on this node, independent of the affinity of this process
+        (eg in a pinned worker), None if it can't be determined
+    """
+    topology = Topology.from_sys(proc_status=os.devnull)
+    cpuset = get_cpuset_cpus()
+    if topology is not None and cpuset:
+        cpuset = set(cpuset)
+        cpus = [cpu for cpu in topology.cpus if cpu in cpuset]
+        if cpus:
+            topology = Topology(cpus, topology.core_of, topology.numa_of, topology.l3_of)
+    return topology
+
+
+def get_allowed_cpus(proc_status=PROC_STATUS):
+    """Return the list of cpus this process is allowed to run on, None if unknown"""
+    regex = re.search(r'^Cpus_allowed_list:\s*(\S+)', read_file(proc_status, ''), re.M)
+    if regex:
+        return parse_cpulist(regex.group(1))
+    return None
+
+
+def get_topology():
+    """Return the (cached) topology of this node, None if it can't be determined"""
+    global _topology
+    if _topology is None:
+        _topology = Topology.from_sys()
+    return _topology
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Start SCOOP workers with a tree of per-host agents
+
+The hosts are numbered 1..N as nodes of a tree with fanout F, the launcher is node 0.
+The children of node n are nodes n*F+1 .. n*F+F.
+Each agent first starts (over ssh) the agents of its children, then the workers on its own host.
+Launching N hosts takes O(F * log_F(N)) sequential ssh starts instead of O(N).
+The host with the origin worker is started by the launcher, with an agent for node 0 that starts no children.
+
+Every agent runs in its own process group (with the workers on its host and the ssh processes of its children),
+and writes the process group id next to the spec file. SIGTERM or SIGHUP kills the process group.
+The remote agents are not signalled when the ssh process that started them is terminated,
+so the launcher cleans up with a second tree of agents in kill mode: each one starts the kill agents of
+its children and kills the process group of the agent on its host.
+
+The spec file (written by the launcher in the mympirundir) is a json dict with
+    hosts: list of [hostname, shell command to start all workers on that host]
+    origin: [hostname, shell command] of the host with the origin worker
+    fanout: the fanout
+    ssh: the ssh command (as list)
+    agent: shell command template to start an agent, with %(node)s as placeholder
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+
+DEFAULT_FANOUT = 8
+# extra argument of the agent to kill the process group of the agent of the node
+KILL_MODE = 'kill'
+
+
+def get_children(node, fanout, nr_hosts):
+    """Return the child nodes of node"""
+    first = node * fanout + 1
+    return range(first, min(first + fanout, nr_hosts + 1))
+
+
+def get_host(spec, node):
+    """Return [hostname, command] of node (node 0 is the host of the origin worker)"""
+    if node == 0:
+        return spec['origin']
+    return spec['hosts'][node - 1]
+
+
+def get_pgid_filename(specfile, node):
+    """Return the name of the file with the process group id of the agent of node"""
+    return "%s.%s.pgid" % (specfile, node)
+
+
+def write_spec(filename, hosts, origin, fanout, ssh, agent):
+    """Write the spec file, returns the spec"""
+    spec = {
+        'hosts': hosts,
+        'origin': origin,
+        'fanout': fanout,
+        'ssh': ssh,
+        'agent': agent,
+    }
+    fh = open(filename, 'w')
+    json.dump(spec, fh)
+    fh.close()
+    return spec
+
+
+def read_spec(filename):
+    """Read the spec file"""
+    fh = open(filename)
+    spec = json.load(fh)
+    fh.close()
+    return spec
+
+
+def get_agent_command(spec, node, kill=False):
+    """Return the shell command to start the agent of node"""
+    cmd = spec['agent'] % {'node': node}
+    if kill:
+        cmd = "%s %s" % (cmd, KILL_MODE)
+    return cmd
+
+
+def start_agent(spec, node, kill=False):
+    """Start the agent for node over ssh, returns the Popen instance"""
+    hostname = get_host(spec, node)[0]
+    return subprocess.Popen(spec['ssh'] + [hostname, get_agent_command(spec, node, kill=kill)])
+
+
+def start_children(spec, node, kill=False):
+    """Start the agents of all children of node, returns the list of Popen instances"""
+    return [start_agent(spec, child, kill=kill) for child in get_children(node, spec['fanout'], len(spec['hosts']))]
+
+
+def kill_node(specfile, node):
+    """Kill the process group of the agent of node (if it was started on this host)"""
+    pgid_fn = get_pgid_filename(specfile, node)
+    try:
+        fh = open(pgid_fn)
+        pgid = int(fh.read().strip())
+        fh.close()
+    except (IOError, ValueError):
+        return
+
+    if pgid != os.getpgrp():
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError:
+            pass
+    try:
+        os.remove(pgid_fn)
+    except OSError:
+        pass
+
+
+def main():
+    """Agent for one node: start the children, then the local workers, and wait for all of them
+        in kill mode: start the kill agents of the children and kill the process group of the agent of the node
+    """
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: %s <specfile> <node> [%s]\n" % (sys.argv[0], KILL_MODE))
+        sys.exit(1)
+
+    specfile = sys.argv[1]
+    spec = read_spec(specfile)
+    node = int(sys.argv[2])
+    kill = sys.argv[3:4] == [KILL_MODE]
+
+    def agent_children():
+        """Start the agents of the children, the launcher starts those of node 0"""
+        if node == 0:
+            return []
+        return start_children(spec, node, kill=kill)
+
+    if kill:
+        processes = agent_children()
+        kill_node(specfile, node)
+        for process in processes:
+            process.wait()
+        sys.exit(0)
+
+    # the children and the workers are started in the process group of the agent
+    try:
+        os.setpgrp()
+    except OSError:
+        # already a session leader (and so a process group leader)
+        pass
+    fh = open(get_pgid_filename(specfile, node), 'w')
+    fh.write("%s\n" % os.getpgrp())
+    fh.close()
+
+    def terminate(signum, frame):
+        """Kill the children and the workers, they are all in the process group of the agent"""
+        signal.signal(signum, signal.SIG_IGN)
+        try:
+            os.killpg(os.getpgrp(), signum)
+        except OSError:
+            pass
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+    processes = agent_children()
+    shell = os.environ.get('SHELL', '/bin/sh')
+    processes.append(subprocess.Popen(get_host(spec, node)[1], shell=True, executable=shell))
+
+    ec = 0
+    for process in processes:
+        ec = max(ec, process.wait())
+    sys.exit(ec)
+
+if __name__ == '__main__':
+    main()
@@ -25,13 +25,37 @@
 ##
 """
 SCOOP piCalc exmaple module
+
+Every batch draws its samples from its own random stream, seeded with (seed, batch index),
+so the result only depends on the seed, nr_batches and batch_size (not on the worker that ran a batch).
+With numpy, the samples are drawn and tested in blocks of BLOCK_SIZE (that fit in the cache),
+without numpy the pure python loop is used (with different streams, so different results).
+
+With --rate, the samples/s per worker (core) and per host are printed, as calibration of the nodes.
 """
+import os
+import sys
+import time
 from math import hypot
-from random import random
+from random import Random
 from scoop import futures
+from vsc.mympirun.scoop.worker_utils import get_worker_context
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except:
+    HAS_NUMPY = False
 
 NAME = 'SCOOP_piCalc'
 
+# samples per block: 2 arrays of float64 of 256kB
+BLOCK_SIZE = 32 * 1024
+
+DEFAULT_SEED = 12345
+# keeps the python streams of (seed, batch index) apart
+SEED_STRIDE = 2 ** 32
+
 # A range is used in this function for python3. If you are using python2,
 # an xrange might be more efficient.
 try:
@@ -40,27 +64,91 @@ except:
     range_fn = range
 
 
-def test(tries):
-    return sum(hypot(random(), random()) < 1 for i in range_fn(tries))
+def get_rng(seed, index):
+    """Return the random stream of batch index"""
+    if HAS_NUMPY:
+        return numpy.random.RandomState([seed, index])
+    else:
+        return Random(seed * SEED_STRIDE + index)
+
+
+def count_inside(rng, tries):
+    """Number of the tries random points in the unit square that are inside the unit circle"""
+    if not HAS_NUMPY:
+        random = rng.random
+        return sum(hypot(random(), random()) < 1 for i in range_fn(tries))
+
+    inside = 0
+    left = tries
+    while left > 0:
+        size = min(left, BLOCK_SIZE)
+        x = rng.random_sample(size)
+        y = rng.random_sample(size)
+        # hypot(x, y) < 1, in place
+        x *= x
+        y *= y
+        x += y
+        inside += int(numpy.count_nonzero(x < 1.0))
+        left -= size
+    return inside
+
+
+def test(args):
+    """Run batch (index, tries, seed), returns (number inside, host, worker, elapsed time)"""
+    index, tries, seed = args
+    start = time.time()
+    inside = count_inside(get_rng(seed, index), tries)
+    context = get_worker_context()
+    return inside, context.host, context.name or "%s" % os.getpid(), time.time() - start
 
 # Calculates pi with a Monte-Carlo method. This function calls the function
 # test "n" times with an argument of "t". Scoop dispatches these
 # functions interactively accross the available ressources.
-def calcPi(workers, tries):
-    expr = futures.map(test, [tries] * workers)
-    piValue = 4. * sum(expr) / float(workers * tries)
-    return piValue
+def calcPi(workers, tries, seed=DEFAULT_SEED):
+    """Return pi and the list of batch results"""
+    res = list(futures.map(test, [(index, tries, seed) for index in range_fn(workers)]))
+    piValue = 4. * sum([x[0] for x in res]) / float(workers * tries)
+    return piValue, res
+
+
+def report_rate(res, tries, elapsed):
+    """Print the samples/s per worker (core) and per host"""
+    hosts = {}
+    for _, host, worker, batch_time in res:
+        hosts.setdefault(host, {}).setdefault(worker, []).append(batch_time)
+
+    total = len(res) * tries
+    print "RATE total %.4g samples/s (%d samples in %.3fs, numpy %s)" % (total / elapsed, total, elapsed, HAS_NUMPY)
+    for host in sorted(hosts):
+        workers = hosts[host]
+        # rate of a worker while it is running batches
+        rates = [len(times) * tries / (sum(times) or 1e-9) for times in workers.values()]
+        nr_samples = sum([len(times) for times in workers.values()]) * tries
+        print "  Host %s workers %d samples/s per worker avg %.4g min %.4g max %.4g node %.4g" % (
+            host, len(workers), sum(rates) / len(rates), min(rates), max(rates), nr_samples / elapsed)
 
 
 if __name__ == '__main__':
-    import sys
     nr_batches = 3000
     batch_size = 5000
+    seed = DEFAULT_SEED
+
+    args = sys.argv[1:]
+    rate = '--rate' in args
+    if rate:
+        args.remove('--rate')
 
     try:
-        nr_batches = int(sys.argv[1])
-        batch_size = int(sys.argv[2])
+        nr_batches = int(args[0])
+        batch_size = int(args[1])
+        seed = int(args[2])
     except:
         pass
 
-    print "PI=%f (in nr_batches=%d,batch_size=%d)" % (calcPi(nr_batches, batch_size), nr_batches, batch_size)
+    s_t = time.time()
+    piValue, res = calcPi(nr_batches, batch_size, seed=seed)
+    elapsed = time.time() - s_t
+
+    print "PI=%f (in nr_batches=%d,batch_size=%d)" % (piValue, nr_batches, batch_size)
+    if rate:
+        report_rate(res, batch_size, elapsed)
@@ -25,11 +25,21 @@
 ##
 """
 Small test to print some execution details and statistics
+
+With --verify, the placement of the workers is checked instead: every worker reports its host, pid,
+cpu set and NUMA nodes, and samples the cpu usage of its node while it sleeps (so the workers don't load the node).
+Per host it reports workers that are not pinned or share cpus, workers that share a core through
+SMT siblings (with at most one worker per core), idle cores and cpus busy with something else (external load).
+The free origin (--scoop_freeorigin) is not pinned on purpose, it is left out of these checks.
+With --strict, the exit code is 1 if any problem was found.
 """
 import os
 import sys
 import time
-from vsc.mympirun.scoop.worker_utils import get_scoop_env, fix_freeorigin
+import scoop
+from vsc.mympirun.scoop.membind import get_membind
+from vsc.mympirun.scoop.topology import PROC_STATUS, read_file, parse_cpulist, make_cpulist, get_host_topology
+from vsc.mympirun.scoop.worker_utils import get_worker_context, fix_freeorigin
 from scoop import futures
 
 try:
@@ -41,27 +51,168 @@ except:
 NAME = 'sanity'
 _DEBUG = True
 
+VERIFY_SAMPLE = 0.2  # seconds each verify task sleeps while the cpu usage of the node is sampled
+VERIFY_ROUNDS = 10  # maximum number of maps to reach all workers
+VERIFY_BUSY = 0.5  # fraction of the time a cpu is busy to count as loaded
+
 def sanity(counter):
     s_t = time.time()
-    worker = get_scoop_env('worker_name')
-    origin = get_scoop_env('worker_origin')
-    freeorigin = get_scoop_env('worker_freeorigin')
+    context = get_worker_context()
+    worker = context.name
+    origin = int(context.origin)
+    freeorigin = int(context.freeorigin)
     delta = time.time() - s_t
     if HAS_PSUTIL:
         affinity = psutil.Process(os.getpid()).get_cpu_affinity()
     else:
         affinity = None
-    return counter, worker, origin, delta, affinity, freeorigin
+    membind = get_membind()
+    return counter, worker, origin, delta, affinity, freeorigin, membind
+
+def read_cpu_times():
+    """Return dict cpu: (busy, total) time from /proc/stat"""
+    res = {}
+    for line in (read_file('/proc/stat', '') or '').splitlines():
+        if line.startswith('cpu') and line[3:4].isdigit():
+            fields = line.split()
+            times = [int(x) for x in fields[1:]]
+            # idle and iowait
+            res[int(fields[0][3:])] = (sum(times) - sum(times[3:5]), sum(times))
+    return res
+
+def verify_info(counter):
+    """Return dict with the placement of this worker and the load of its node"""
+    before = read_cpu_times()
+    time.sleep(VERIFY_SAMPLE)
+    after = read_cpu_times()
+    busy = []
+    for cpu, (busy_time, total) in after.items():
+        if cpu in before and total > before[cpu][1]:
+            if 1.0 * (busy_time - before[cpu][0]) / (total - before[cpu][1]) > VERIFY_BUSY:
+                busy.append(cpu)
+
+    cpus = []
+    for line in (read_file(PROC_STATUS, '') or '').splitlines():
+        if line.startswith('Cpus_allowed_list:'):
+            cpus = parse_cpulist(line.split(':', 1)[1])
+    context = get_worker_context()
+    topology = get_host_topology()
+    if topology is None:
+        cores = [[cpu] for cpu in cpus]
+        nodes = []
+    else:
+        cores = topology.cores
+        nodes = sorted(set([topology.numa_of[cpu] for cpu in cpus if cpu in topology.numa_of]))
+
+    return {
+        'host': context.host,
+        'pid': os.getpid(),
+        'worker': context.name,
+        'rank': context.rank,
+        'origin': context.origin,
+        'freeorigin': context.freeorigin and context.origin,
+        'cpus': cpus,
+        'nodes': nodes,
+        'cores': cores,
+        'busy': busy,
+        'loadavg': float((read_file('/proc/loadavg', '0') or '0').split()[0]),
+    }
+
+def verify_host(infos):
+    """Check the placement of the workers of one host, returns (summary, list of problems)"""
+    cores = infos[0]['cores']
+    core_of = dict([(cpu, idx) for idx, core in enumerate(cores) for cpu in core])
+    host_cpus = set(core_of.keys())
+    problems = []
+
+    # the free origin has no affinity (see fix_freeorigin), it is left out of the placement checks
+    placed = [info for info in infos if not info['freeorigin']]
+
+    unpinned = [info for info in placed if len(host_cpus) > 1 and host_cpus.issubset(info['cpus'])]
+    if len(placed) > 1 and unpinned:
+        problems.append("%d of %d workers not pinned" % (len(unpinned), len(placed)))
+
+    owners = {}
+    core_workers = {}
+    for idx, info in enumerate(placed):
+        for cpu in info['cpus']:
+            owners[cpu] = owners.get(cpu, 0) + 1
+            if cpu in core_of:
+                core_workers.setdefault(core_of[cpu], set()).add(idx)
+
+    shared = [cpu for cpu, nr in owners.items() if nr > 1]
+    if shared and not unpinned:
+        problems.append("cpus %s shared by several workers" % make_cpulist(shared))
+
+    if len(placed) <= len(cores):
+        # only siblings: the workers share the core, not a cpu
+        siblings = [idx for idx, workers in core_workers.items()
+                    if len(workers) > 1 and not [cpu for cpu in cores[idx] if owners.get(cpu, 0) > 1]]
+        if siblings:
+            problems.append("%d cores shared through SMT siblings (cpus %s)" %
+                            (len(siblings), make_cpulist(sum([cores[idx] for idx in siblings], []))))
+
+    idle = [idx for idx in range(len(cores)) if idx not in core_workers]
+    if idle and (len(placed) >= len(cores) or shared or len(core_workers) < len(placed)):
+        problems.append("%d idle cores (cpus %s)" % (len(idle), make_cpulist(sum([cores[idx] for idx in idle], []))))
+
+    # busy in the majority of the samples (the origin and broker can be busy in some of them)
+    busy_count = {}
+    for info in infos:
+        for cpu in info['busy']:
+            busy_count[cpu] = busy_count.get(cpu, 0) + 1
+    busy = [cpu for cpu, nr in busy_count.items() if 2 * nr > len(infos)]
+    external = [cpu for cpu in busy if cpu in owners]
+    if external:
+        problems.append("external load on worker cpus %s" % make_cpulist(external))
+
+    summary = "workers %d cpus %d cores %d numa %s loadavg %.2f busy cpus %d" % (
+        len(infos), len(host_cpus), len(cores), make_cpulist(set(sum([info['nodes'] for info in infos], []))) or '-',
+        max([info['loadavg'] for info in infos]), len(busy))
+    return summary, problems
+
+def verify():
+    """Gather the placement of all workers and check it per host, returns the number of problems"""
+    size = getattr(scoop, 'SIZE', None)
+    # the origin might not run any task (eg with freeorigin)
+    info = verify_info(None)
+    infos = {(info['host'], info['pid']): info}
+    for _ in range(VERIFY_ROUNDS):
+        for info in futures.map(verify_info, range(2 * max(size or 1, len(infos)))):
+            infos[(info['host'], info['pid'])] = info
+        if size is None or len(infos) >= size:
+            break
+
+    hosts = {}
+    for info in infos.values():
+        hosts.setdefault(info['host'], []).append(info)
+
+    nr_problems = 0
+    print "VERIFY %d workers (of %s) on %d hosts" % (len(infos), size, len(hosts))
+    for host in sorted(hosts):
+        summary, problems = verify_host(sorted(hosts[host], key=lambda x: x['cpus']))
+        nr_problems += len(problems)
+        print "  Host %s %s: %s" % (host, summary, (problems and 'PROBLEM') or 'OK')
+        for problem in problems:
+            print "    %s" % problem
+    return nr_problems
 
 if __name__ == '__main__':
+    args = sys.argv[1:]
+    fix_freeorigin()
+
+    if '--verify' in args:
+        nr_problems = verify()
+        if '--strict' in args and nr_problems:
+            sys.exit(1)
+        sys.exit(0)
+
     nr_batches = 1000
     try:
-        nr_batches = int(sys.argv[1])
+        nr_batches = int(args[0])
     except:
         pass
 
-    fix_freeorigin()
-
     s_t = time.time()
     res_generator = futures.map(sanity, xrange(nr_batches))
     res = [x for x in res_generator]
@@ -74,17 +225,19 @@ if __name__ == '__main__':
 
     workers = dict([(x, []) for x in set([y[1] for y in res])])
     for y in res:
-        workers[y[1]].append((y[3], y[4], "%s/%s" % (y[2], y[5])))
+        workers[y[1]].append((y[3], y[4], "%s/%s" % (y[2], y[5]), y[6]))
 
-    ## TODO use scipy statistics. but you get the point
-    ## TODO remove origin worker from stats
-    print "avg %d, min %d, max %d number of batches per worker" % (nr_batches / len(workers),
-                                                                   min([len(x) for x in workers.values()]),
-                                                                   max([len(x) for x in workers.values()]),
+    ## the origin worker also runs the main part, it is left out of the batches per worker
+    ## (see the scoopbench module for throughput, latency and imbalance statistics)
+    counts = [len(workers[w]) for w in workers if not workers[w][0][2].startswith('1/')] or [0]
+    print "avg %d, min %d, max %d number of batches per worker" % (sum(counts) / len(counts),
+                                                                   min(counts),
+                                                                   max(counts),
                                                                    )
     for w in workers:
-        print "  Worker %s nr_batches %s affinity %s (origin %s)" % (w,
-                                                         len(workers[w]),
-                                                         workers[w][0][1],
-                                                         workers[w][0][2],
-                                                         )
+        print "  Worker %s nr_batches %s affinity %s membind %s (origin %s)" % (w,
+                                                                    len(workers[w]),
+                                                                    workers[w][0][1],
+                                                                    workers[w][0][3],
+                                                                    workers[w][0][2],
+                                                                    )
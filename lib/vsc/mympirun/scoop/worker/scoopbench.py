@@ -0,0 +1,218 @@
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+SCOOP throughput and latency benchmark
+
+Sweeps task duration (busy loop), argument size and result size, and measures for each setting
+    map: futures.map throughput of --tasks tasks (tasks/s and efficiency: busy time / (elapsed * workers))
+    latency: round trip percentiles of --latency-tasks tasks submitted one at a time, minus the task duration
+    imbalance: number of tasks per worker in the map (the origin worker is reported separately)
+A warmup map first measures the time from the start of each worker process to its first task.
+
+The report is printed as json (or written to --output), eg to compare scheduler settings,
+--scoop_freeorigin or a new SCOOP/zmq/python installation.
+
+e.g. myscoop --sched=local --scoop_module=scoopbench --durations=0,0.001,0.01 --arg-sizes=0,65536
+"""
+import json
+import os
+import time
+from scoop import futures
+from vsc.mympirun.scoop.worker_utils import get_worker_context, fix_freeorigin
+from vsc.utils.generaloption import simple_option
+
+NAME = 'scoopbench'
+
+PERCENTILES = [50, 90, 99]
+
+_process_start = None
+
+
+def get_process_start():
+    """Return the start time (epoch) of this process, from /proc (cached)"""
+    global _process_start
+    if _process_start is None:
+        try:
+            fh = open('/proc/self/stat')
+            # the command can contain spaces, the fields after it can't
+            starttime = int(fh.read().rsplit(')', 1)[1].split()[19])
+            fh.close()
+            fh = open('/proc/stat')
+            btime = [int(line.split()[1]) for line in fh if line.startswith('btime')][0]
+            fh.close()
+            _process_start = btime + 1.0 * starttime / os.sysconf('SC_CLK_TCK')
+        except (IOError, OSError, IndexError, ValueError):
+            _process_start = time.time()
+    return _process_start
+
+
+def get_worker():
+    """Return the name of this worker and if it is the origin"""
+    context = get_worker_context()
+    return context.name or "%s:%s" % (context.host, os.getpid()), context.origin
+
+
+def bench_task(args):
+    """Busy loop for duration seconds, returns (worker, origin, start time, process start time, result)
+        args is (duration, payload, result size), the payload is only there to be sent
+    """
+    start = time.time()
+    duration, _, result_size = args
+    end = start + duration
+    while time.time() < end:
+        pass
+    worker, origin = get_worker()
+    return worker, origin, start, get_process_start(), 'x' * result_size
+
+
+def percentiles(values, pcts=None):
+    """Return dict with the (nearest rank) percentiles, min, max and mean of values"""
+    if pcts is None:
+        pcts = PERCENTILES
+    if not values:
+        return None
+    values = sorted(values)
+    res = {
+        'min': values[0],
+        'max': values[-1],
+        'mean': sum(values) / len(values),
+    }
+    for pct in pcts:
+        res['p%s' % pct] = values[min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))]
+    return res
+
+
+def imbalance(results):
+    """Return the task count statistics of the non-origin workers, from a list of bench_task results
+        imbalance is max / mean - 1 (0 is perfectly balanced)
+    """
+    counts = {}
+    origin_count = 0
+    for worker, origin, _, _, _ in results:
+        if origin:
+            origin_count += 1
+        else:
+            counts[worker] = counts.get(worker, 0) + 1
+
+    res = {'origin': origin_count, 'workers': len(counts)}
+    if counts:
+        stats = percentiles([1.0 * x for x in counts.values()], pcts=[])
+        mean = stats['mean']
+        stats['stddev'] = (sum([(x - mean) ** 2 for x in counts.values()]) / len(counts)) ** 0.5
+        stats['imbalance'] = stats['max'] / mean - 1
+        res.update(stats)
+    return res
+
+
+def bench_map(nr_tasks, duration, arg_size, result_size):
+    """Run nr_tasks with futures.map, returns (elapsed time, list of results)"""
+    args = [(duration, 'x' * arg_size, result_size)] * nr_tasks
+    start = time.time()
+    results = list(futures.map(bench_task, args))
+    return time.time() - start, results
+
+
+def bench_latency(nr_tasks, duration, arg_size, result_size):
+    """Run nr_tasks one at a time, returns the list of round trip times minus duration"""
+    args = (duration, 'x' * arg_size, result_size)
+    latencies = []
+    for _ in range(nr_tasks):
+        start = time.time()
+        futures.submit(bench_task, args).result()
+        latencies.append(time.time() - start - duration)
+    return latencies
+
+
+def bench_startup(nr_tasks):
+    """Time from the start of each worker process to its first task (the origin is not included)
+        first_result is the time from the start of the origin to the first result of a map
+    """
+    origin_start = get_process_start()
+    args = [(0, '', 0)] * nr_tasks
+    first_result = None
+    first_task = {}  # worker: (first task start, process start)
+    for worker, origin, start, process_start, _ in futures.map(bench_task, args):
+        if first_result is None:
+            first_result = time.time() - origin_start
+        if not origin and (worker not in first_task or start < first_task[worker][0]):
+            first_task[worker] = (start, process_start)
+
+    return {'first_result': first_result,
+            'first_task': percentiles([start - process_start for start, process_start in first_task.values()]),
+            }
+
+
+def main():
+    options = {
+        'durations': ("Task durations in seconds", 'strlist', 'store', ['0', '0.001', '0.01']),
+        'arg-sizes': ("Task argument sizes in bytes", 'strlist', 'store', ['0', '65536']),
+        'result-sizes': ("Task result sizes in bytes", 'strlist', 'store', ['0', '65536']),
+        'tasks': ("Number of tasks of each map", 'int', 'store', 1000),
+        'latency-tasks': ("Number of tasks of each latency measurement", 'int', 'store', 100),
+        'warmup-tasks': ("Number of tasks of the warmup (startup) map", 'int', 'store', 1000),
+        'output': ("Write the json report to this file (- for stdout)", 'str', 'store', '-'),
+    }
+    go = simple_option(options)
+
+    fix_freeorigin()
+
+    report = {
+        'freeorigin': get_worker_context().freeorigin,
+        'startup': bench_startup(go.options.warmup_tasks),
+        'settings': [],
+    }
+
+    for duration in [float(x) for x in go.options.durations]:
+        for arg_size in [int(x) for x in go.options.arg_sizes]:
+            for result_size in [int(x) for x in go.options.result_sizes]:
+                elapsed, results = bench_map(go.options.tasks, duration, arg_size, result_size)
+                counts = imbalance(results)
+                nr_workers = counts['workers'] + int(counts['origin'] > 0)
+                setting = {
+                    'duration': duration,
+                    'arg_size': arg_size,
+                    'result_size': result_size,
+                    'map': {
+                        'tasks': go.options.tasks,
+                        'elapsed': elapsed,
+                        'tasks_per_s': go.options.tasks / elapsed,
+                        'efficiency': go.options.tasks * duration / (elapsed * max(1, nr_workers)),
+                    },
+                    'latency': percentiles(bench_latency(go.options.latency_tasks, duration, arg_size, result_size)),
+                    'imbalance': counts,
+                }
+                report['settings'].append(setting)
+
+    txt = json.dumps(report, sort_keys=True, indent=2)
+    if go.options.output == '-':
+        print(txt)
+    else:
+        fh = open(go.options.output, 'w')
+        fh.write(txt + "\n")
+        fh.close()
+
+if __name__ == '__main__':
+    main()
@@ -26,43 +26,608 @@
 """
 SCOOP run of command and args in repeated environment
     provide environment variables so apps can benefit
+
+With SCOOP_TASKS set (myscoop --scoop_tasks), the tasks are the lines of that file (or stdin for -),
+read lazily by the origin; the counter is the line number and the line is appended to the command
+(or replaces {} in it); without command, the line is the command.
+
+With SCOOP_OUTPUT_DIR set (myscoop --scoop_output-dir), the output of each task is written to a file
+in that directory on the node that ran it, and only a dict with counter, ec, bytes, host, file
+and the first SCOOP_OUTPUT_PREVIEW bytes of output is returned (file is None if the output fits in the preview).
+
+With SCOOP_CHUNK set (myscoop --scoop_chunk), each future runs that many counters (or task lines)
+back to back and returns the list of their results.
+
+With SCOOP_CONCURRENCY set (myscoop --scoop_concurrency), each worker runs up to that many commands
+of its chunk at the same time (the chunk is at least that large), eg for I/O bound commands.
+The commands inherit the affinity of the worker.
+
+With SCOOP_JOURNAL set (myscoop --scoop_journal), every result is also appended to that journal;
+counters with a successful result (ec 0) in the journal (from a previous run) are skipped, failed ones run again.
+
+With SCOOP_CACHE set (myscoop --scoop_cache), successful results are cached in that directory,
+keyed by the expanded command, the output and accounting mode, the SCOOP_CACHE_ENV variables
+and the SCOOP_CACHE_INPUTS files; the origin looks up every counter (or whole chunk) before submitting it,
+hits never reach a worker. Output spilled to a file is not cached, cached results have no usage.
+
+Commands without shell features (other than $SCOOP_COUNTER, which is substituted here)
+whose program is on PATH and is not a shell builtin or keyword are executed directly, without shell,
+with posix_spawnp when available (fork/exec otherwise).
+
+With SCOOP_TIMEOUT set (myscoop --scoop_timeout), a command that runs longer than that many seconds
+is killed with its process group (the command and everything it started), its result has ec TIMEOUT_EC.
+With SCOOP_SPECULATE set (myscoop --scoop_speculate), the tasks still running once that fraction is done
+are submitted once more, the first result is used.
+
+With SCOOP_ACCOUNTING set (myscoop --scoop_accounting), the result of every command also has its resource usage
+(wall time, user and system cpu time, max RSS and the I/O counters of /proc/<pid>/io, see get_usage);
+the origin prints a summary per worker and per host at the end (on stderr).
+
+The results are written as they come in, one record per counter (see worker_utils.ResultStream),
+as json lines (default) or pickles, to stdout or the file in SCOOP_RESULTS.
 """
+import gzip
+import os
+import re
+import resource
+import select
+import signal
+import socket
 import sys
+import time
+from collections import deque
 from vsc.utils.run import run_simple
-from vsc.mympirun.scoop.worker_utils import set_scoop_env, parse_worker_args, make_worker_log, fix_freeorigin
-from scoop import futures
+from vsc.mympirun.scoop.worker_utils import set_scoop_env, get_scoop_env, get_scoop_env_bool, _get_scoop_env_name
+from vsc.mympirun.scoop.worker_utils import parse_worker_args, make_worker_log, fix_freeorigin
+from vsc.mympirun.scoop.worker_utils import stream_map, get_result_stream, read_tasks, chunked, Journal
+from vsc.mympirun.scoop.worker_utils import ResultCache, get_input_signature, UsageSummary, get_worker_context
 
 NAME = 'simple_shell'
-_DEBUG = True
+_DEBUG = False
+
+OUTPUT_CHUNK = 64 * 1024
+OUTPUT_SHELL = '/bin/bash'
+
+TASK_PLACEHOLDER = '{}'
+
+# anything the shell would interpret, after removing the counter references
+SHELL_FEATURES_REGEXP = re.compile(r'[|&;<>()$`\\"\'*?\[\]{}~#\n]')
+COUNTER_REFERENCE_REGEXP = re.compile(r'\$(SCOOP_COUNTER\b|\{SCOOP_COUNTER\})')
+# bash builtins and keywords (compgen -b, compgen -k): only OUTPUT_SHELL runs these as the shell would
+SHELL_BUILTINS = set(['.', ':', '[', 'alias', 'bg', 'bind', 'break', 'builtin', 'caller', 'cd', 'command', 'compgen',
+                      'complete', 'compopt', 'continue', 'declare', 'dirs', 'disown', 'echo', 'enable', 'eval',
+                      'exec', 'exit', 'export', 'false', 'fc', 'fg', 'getopts', 'hash', 'help', 'history', 'jobs',
+                      'kill', 'let', 'local', 'logout', 'mapfile', 'popd', 'printf', 'pushd', 'pwd', 'read',
+                      'readarray', 'readonly', 'return', 'set', 'shift', 'shopt', 'source', 'suspend', 'test',
+                      'times', 'trap', 'true', 'type', 'typeset', 'ulimit', 'umask', 'unalias', 'unset', 'wait',
+                      'if', 'then', 'else', 'elif', 'fi', 'case', 'esac', 'for', 'select', 'while', 'until', 'do',
+                      'done', 'in', 'function', 'time', '{', '}', '!', '[[', ']]', 'coproc'])
+EXEC_FAILED_EC = 127
+# as coreutils timeout
+TIMEOUT_EC = 124
+
+_command = None  # the command without task line, the arguments are only parsed once per worker
+_template = None  # the direct exec template of _command, False if it needs a shell
+_environment = None  # environment of the directly executed commands
+_accounting = None  # collect the resource usage of the commands
+_executables = {}  # program: True if it is found on PATH (or is an executable path)
+
+def get_command(line=None):
+    """Return the command to run
+        line is a task line: it replaces TASK_PLACEHOLDER in the command or is appended to it
+    """
+    global _command
+    if line is None:
+        if _command is None:
+            _command = ' '.join(["%s" % x for x in parse_worker_args()])  ## ready to join
+        return _command
+    else:
+        # no range in the arguments with a task list
+        cmd_sanity = ["%s" % x for x in sys.argv[1:]]
+        if TASK_PLACEHOLDER in cmd_sanity:
+            cmd_sanity = [(x == TASK_PLACEHOLDER and line) or x for x in cmd_sanity]
+        else:
+            cmd_sanity.append(line)
+    return ' '.join(cmd_sanity)
+
+def is_executable(program):
+    """Return True if program is an executable path or is found on PATH (cached)"""
+    if not program in _executables:
+        if os.sep in program:
+            candidates = [program]
+        else:
+            candidates = [os.path.join(x or '.', program) for x in os.environ.get('PATH', os.defpath).split(os.pathsep)]
+        _executables[program] = any([os.path.isfile(x) and os.access(x, os.X_OK) for x in candidates])
+    return _executables[program]
+
+def make_template(cmd):
+    """Return cmd as list of words to execute directly, False if it needs a shell"""
+    if SHELL_FEATURES_REGEXP.search(COUNTER_REFERENCE_REGEXP.sub('', cmd)):
+        return False
+    words = cmd.split()
+    if not words or '=' in words[0] or '$' in words[0]:
+        # nothing to run, a variable assignment or a program that depends on the counter
+        return False
+    if words[0] in SHELL_BUILTINS or not is_executable(words[0]):
+        # the shell runs builtins and keywords, and reports commands that are not found
+        return False
+    return words
+
+def get_template(line=None):
+    """Return the direct exec template of the command (cached without task line), False if it needs a shell"""
+    global _template
+    if line is None:
+        if _template is None:
+            _template = make_template(get_command())
+        return _template
+    else:
+        return make_template(get_command(line))
+
+def fill_template(template, counter):
+    """Return the argv for counter"""
+    counter = "%s" % counter
+    return [('$' in word and COUNTER_REFERENCE_REGEXP.sub(counter, word)) or word for word in template]
+
+def get_environment(counter):
+    """Return the environment for the directly executed command of counter
+        the dict is made once per worker and updated in place
+    """
+    global _environment
+    if _environment is None:
+        _environment = dict(os.environ)
+    _environment[_get_scoop_env_name('counter')] = "%s" % counter
+    return _environment
+
+def get_accounting():
+    """Return True if the resource usage of the commands is collected (cached)"""
+    global _accounting
+    if _accounting is None:
+        _accounting = get_scoop_env_bool('accounting')
+    return _accounting
+
+def read_proc_io(pid):
+    """Return dict with the I/O counters of pid from /proc/<pid>/io (empty if not available)"""
+    res = {}
+    try:
+        fh = open('/proc/%s/io' % pid)
+        for line in fh:
+            key, value = line.split(':', 1)
+            if key in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+                res[key] = int(value)
+        fh.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return res
+
+def _spawn(argv, env, wfd, rfd):
+    """Start argv in its own process group with stdout and stderr to wfd, returns the pid"""
+    if hasattr(os, 'posix_spawnp'):
+        return os.posix_spawnp(argv[0], argv, env, setpgroup=0,
+                               file_actions=[(os.POSIX_SPAWN_DUP2, wfd, 1), (os.POSIX_SPAWN_DUP2, wfd, 2)])
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgid(0, 0)
+            os.close(rfd)
+            os.dup2(wfd, 1)
+            os.dup2(wfd, 2)
+            os.execvpe(argv[0], argv, env)
+        except OSError as err:
+            os.write(2, "%s: %s\n" % (argv[0], err.strerror))
+        os._exit(EXEC_FAILED_EC)
+    return pid
+
+class Command(object):
+    """Command executed directly, with stdout and stderr on one pipe"""
+    def __init__(self, argv, counter):
+        self.error = None
+        self.usage = None
+        self.rss_baseline = None
+        self.start = time.time()
+        if get_accounting():
+            # the maxrss of the command includes what it inherits from this process (see get_usage)
+            self.rss_baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rfd, wfd = os.pipe()
+        try:
+            self.pid = _spawn(argv, get_environment(counter), wfd, rfd)
+            self.fd = rfd
+        except OSError as err:
+            # eg command not found with posix_spawnp
+            os.close(rfd)
+            self.pid = None
+            self.fd = None
+            self.error = "%s: %s\n" % (argv[0], err.strerror)
+        os.close(wfd)
+
+    def read(self, size):
+        """Read up to size bytes of output, empty at the end"""
+        if self.error is not None:
+            data, self.error = self.error, ''
+            return data
+        if self.fd is None:
+            return ''
+        return os.read(self.fd, size)
+
+    def kill(self):
+        """Kill the process group of the command"""
+        if self.pid is not None:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except OSError:
+                # already gone
+                pass
+
+    def wait(self):
+        """Wait for the command, returns the exit code (128 + signal if killed)
+            with accounting, the resource usage is in usage
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.pid is None:
+            return EXEC_FAILED_EC
+        if get_accounting():
+            # the output is closed, so the command is (almost) done; /proc/<pid>/io is gone once it is reaped
+            proc_io = read_proc_io(self.pid)
+            status, rusage = os.wait4(self.pid, 0)[1:]
+            self.usage = get_usage(time.time() - self.start, rusage, proc_io, self.rss_baseline)
+        else:
+            status = os.waitpid(self.pid, 0)[1]
+        if os.WIFSIGNALED(status):
+            return 128 + os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+def get_usage(wall, rusage, proc_io, rss_baseline):
+    """Return the resource usage dict of a command
+        wall, utime and stime in seconds, maxrss in kB (of the largest process the command waited for),
+        rchar, wchar, read_bytes and write_bytes from /proc/<pid>/io (of the command process itself)
+        and the host and worker that ran it
+        The command is forked from the worker, its maxrss includes the RSS of the worker at that time:
+        maxrss is None if it is not above rss_baseline (the peak RSS of the worker), the peak of the command
+        is then unknown (at most maxrss_inherited).
+    """
+    maxrss = None
+    if rusage.ru_maxrss > rss_baseline:
+        maxrss = rusage.ru_maxrss
+    usage = {'wall': round(wall, 6),
+             'utime': round(rusage.ru_utime, 6),
+             'stime': round(rusage.ru_stime, 6),
+             'maxrss': maxrss,
+             'maxrss_inherited': rss_baseline,
+             'host': get_worker_context().host,
+             'worker': get_worker_context().name,
+             }
+    usage.update(proc_io)
+    return usage
+
+class InlineOutput(object):
+    """Collect the output of a command, the result is (ec, output)"""
+    def __init__(self, counter):
+        self.out = []
+
+    def write(self, data):
+        self.out.append(data)
+
+    def result(self, ec, usage=None):
+        if usage is None:
+            return ec, ''.join(self.out)
+        else:
+            return ec, ''.join(self.out), usage
+
+def _make_output_dir(output_dir):
+    """Create the output directory (the workers on a node race for it)"""
+    if not os.path.isdir(output_dir):
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            if not os.path.isdir(output_dir):
+                raise
+
+class SpillOutput(object):
+    """Write the output of a command to a file while it is produced
+        the result is a dict with counter, ec, bytes, host, file and output (the preview)
+    """
+    def __init__(self, counter):
+        self.counter = counter
+        output_dir = get_scoop_env('output_dir')
+        self.preview_size = get_scoop_env('output_preview', int) or 0
+        _make_output_dir(output_dir)
+
+        # unique per attempt: a speculative copy of the task (see stream_map) never touches the file of the other
+        self.filename = os.path.join(output_dir, '%s_%s.%s.%s.out' % (NAME, counter, get_worker_context().host,
+                                                                      os.getpid()))
+        if get_scoop_env_bool('output_compress'):
+            self.filename += '.gz'
+            self.fh = gzip.open(self.filename, 'wb')
+        else:
+            self.fh = open(self.filename, 'wb')
+
+        self.preview = []
+        self.nr_bytes = 0
+
+    def write(self, data):
+        if self.nr_bytes < self.preview_size:
+            self.preview.append(data[:self.preview_size - self.nr_bytes])
+        self.nr_bytes += len(data)
+        self.fh.write(data)
+
+    def result(self, ec, usage=None):
+        self.fh.close()
+        filename = self.filename
+        if self.nr_bytes <= self.preview_size:
+            # everything is in the preview
+            os.remove(filename)
+            filename = None
+
+        res = {'counter': self.counter,
+               'ec': ec,
+               'bytes': self.nr_bytes,
+               'host': socket.gethostname(),
+               'file': filename,
+               'output': ''.join(self.preview),
+               }
+        if usage is not None:
+            res['usage'] = usage
+        return res
+
+def make_output(counter):
+    """Return the output for the command of counter"""
+    if get_scoop_env('output_dir') is None:
+        return InlineOutput(counter)
+    else:
+        return SpillOutput(counter)
+
+def start_command(counter, cmd, template):
+    """Start the command of counter (directly if possible), returns the Command"""
+    set_scoop_env('counter', counter)
+    # stdout and stderr together, as run_simple
+    argv = (template and fill_template(template, counter)) or [OUTPUT_SHELL, '-c', cmd]
+    return Command(argv, counter)
+
+def finish_command(proc, output):
+    """Read the remaining output of proc, returns the result"""
+    while True:
+        data = proc.read(OUTPUT_CHUNK)
+        if not data:
+            break
+        output.write(data)
+    ec = proc.wait()
+    return output.result(ec, proc.usage)
+
+def kill_command(proc, output, timeout):
+    """Kill proc after timeout, returns the result"""
+    proc.kill()
+    proc.wait()
+    output.write("\n%s: killed after timeout of %s seconds\n" % (NAME, timeout))
+    return output.result(TIMEOUT_EC, proc.usage)
+
+def get_timeout():
+    """Return the timeout of a command in seconds, None if there is none"""
+    return get_scoop_env('timeout', float) or None
+
+def run_command(counter, cmd, template):
+    """Run cmd with counter set in the environment, returns (ec, output) or the dict with the spilled output"""
+    timeout = get_timeout()
+    if not template and timeout is None and not get_accounting() and get_scoop_env('output_dir') is None:
+        set_scoop_env('counter', counter)
+        ec, out = run_simple(cmd, disable_log=True)
+        return ec, out
+
+    if timeout is None:
+        return finish_command(start_command(counter, cmd, template), make_output(counter))
+    else:
+        return run_concurrent([(counter, cmd, template)], 1, timeout=timeout)[0]
+
+def run_concurrent(tasks, concurrency, timeout=None):
+    """Run the (counter, cmd, template) tasks, at most concurrency at the same time
+        commands still running after timeout seconds are killed
+        returns the list of results, in the order of tasks
+    """
+    results = [None] * len(tasks)
+    todo = deque(enumerate(tasks))
+    running = {}  # fd: (index, Command, output, deadline)
+    poller = select.poll()
+    while todo or running:
+        while todo and len(running) < concurrency:
+            idx, (counter, cmd, template) = todo.popleft()
+            proc = start_command(counter, cmd, template)
+            output = make_output(counter)
+            if proc.fd is None:
+                # failed to start
+                results[idx] = finish_command(proc, output)
+            else:
+                deadline = (timeout is not None and time.time() + timeout) or None
+                running[proc.fd] = (idx, proc, output, deadline)
+                poller.register(proc.fd, select.POLLIN)
+
+        if not running:
+            continue
+
+        wait_ms = None
+        if timeout is not None:
+            wait_ms = max(0, int(1000 * (min([x[3] for x in running.values()]) - time.time())) + 1)
+
+        for fd, _ in poller.poll(wait_ms):
+            idx, proc, output, _ = running[fd]
+            data = proc.read(OUTPUT_CHUNK)
+            if data:
+                output.write(data)
+            else:
+                poller.unregister(fd)
+                del running[fd]
+                ec = proc.wait()
+                results[idx] = output.result(ec, proc.usage)
+
+        if timeout is not None:
+            now = time.time()
+            for fd, (idx, proc, output, deadline) in list(running.items()):
+                if deadline <= now:
+                    poller.unregister(fd)
+                    del running[fd]
+                    results[idx] = kill_command(proc, output, timeout)
+
+    return results
+
+def get_task(item):
+    """Return (counter, cmd, template) for a counter or a task (counter, line)"""
+    if isinstance(item, tuple):
+        counter, line = item
+        return counter, get_command(line), get_template(line)
+    else:
+        return item, get_command(), get_template()
 
 def worker_run_simple(counter):
     """Execute the cmd
         to be called with
     """
-    cmd_sanity = ["%s" % x for x in parse_worker_args()]  ## ready to join
-    set_scoop_env('counter', counter)
-    ec, out = run_simple(' '.join(cmd_sanity), disable_log=True)
+    return run_command(*get_task(counter))  ## return 1 item
+
+def worker_run_task(task):
+    """Execute the cmd for a task (counter, line) from the task list"""
+    return run_command(*get_task(task))
+
+def worker_run_chunk(chunk):
+    """Execute the cmd for each counter or task in chunk, returns the list of results
+        with SCOOP_CONCURRENCY > 1, that many commands run at the same time
+    """
+    tasks = [get_task(item) for item in chunk]
+    concurrency = get_scoop_env('concurrency', int) or 1
+    if concurrency > 1:
+        return run_concurrent(tasks, concurrency, timeout=get_timeout())
+    else:
+        return [run_command(*task) for task in tasks]
+
+def make_cache_key(item, cache_env, input_signature):
+    """Return the cache key of a counter or a task (counter, line)
+        the output mode (inline or the output directory) and the accounting mode are part of the key,
+        so a result is only served to a run that returns the same kind of result
+    """
+    counter, cmd, template = get_task(item)
+    if template:
+        cmd = ' '.join(fill_template(template, counter))
+    else:
+        # the expanded command: the counter references in a shell command are part of the key
+        cmd = COUNTER_REFERENCE_REGEXP.sub("%s" % counter, cmd)
+    output_mode = get_scoop_env('output_dir') or ''
+    counter_name = _get_scoop_env_name('counter')
+    values = [(name == counter_name and counter) or os.environ.get(name, '') for name in cache_env]
+    return ResultCache.make_key(cmd, input_signature, output_mode, get_accounting(), *values)
 
-    return  ec, out  ## return 1 item
+def make_cache_entry(result):
+    """Return the result to cache, None if it can't be cached
+        spilled output that is in a file is not cached (the file can be removed or overwritten),
+        the usage is not cached (a cached result is not a run, it is not counted again)
+    """
+    if isinstance(result, dict):
+        if result['file'] is not None:
+            return None
+        return dict([(k, v) for k, v in result.items() if k != 'usage'])
+    return result[:2]
+
+def cache_lookup(cache, item, cache_env, input_signature):
+    """Return the cached result of a counter or task, or the list of results of a chunk (only if all are cached)"""
+    if isinstance(item, list):
+        results = []
+        for subitem in item:
+            result = cache.get(make_cache_key(subitem, cache_env, input_signature))
+            if result is None:
+                return None
+            results.append(result)
+        return results
+    else:
+        return cache.get(make_cache_key(item, cache_env, input_signature))
+
+def make_record(counter, result):
+    """Return the record to write for the result of counter"""
+    if isinstance(result, dict):
+        return result
+    record = {'counter': counter, 'ec': result[0], 'output': result[1]}
+    if len(result) > 2:
+        record['usage'] = result[2]
+    return record
 
 if __name__ == '__main__':
     _log = make_worker_log(NAME, debug=_DEBUG)
 
     fix_freeorigin()
 
-    worker_func = worker_run_simple
+    tasks = get_scoop_env('tasks')
+    if tasks is None:
+        worker_func = worker_run_simple
+        start, stop, step = parse_worker_args(False)
+        items = xrange(start, stop, step)
+    else:
+        worker_func = worker_run_task
+        items = read_tasks(tasks)
 
-    res = None
-    start, stop, step = parse_worker_args(False)
-    try:
-        _log.debug("main_run: going to start map")
-        res_generator = futures.map(worker_func, xrange(start, stop, step))
-        _log.debug("main_run: finished map")
-        res = [x for x in res_generator]
-        _log.debug("main_run: finished res from generator")
-    except:
-        _log.exception("main_run: main failed with main_func %s with start %s stop %s" % (worker_func, start, stop))
+    journal = None
+    journal_fn = get_scoop_env('journal')
+    if journal_fn is not None:
+        journal = Journal(journal_fn)
+        if journal.done:
+            _log.info("main_run: skipping %s counters that succeeded according to journal %s",
+                      len(journal.done), journal_fn)
+            if tasks is None:
+                items = (item for item in items if not item in journal.done)
+            else:
+                items = (item for item in items if not item[0] in journal.done)
 
-    print res
+    cache = None
+    lookup = None
+    cache_dir = get_scoop_env('cache')
+    if cache_dir is not None:
+        cache = ResultCache(cache_dir, (get_scoop_env('cache_size', int) or 1024) * 1024 * 1024)
+        cache_env = [x for x in (get_scoop_env('cache_env') or '').split(',') if x]
+        cache_inputs = [x for x in (get_scoop_env('cache_inputs') or '').split(',') if x]
+        input_signature = get_input_signature(cache_inputs, content=get_scoop_env_bool('cache_hash_inputs'))
+        lookup = lambda item: cache_lookup(cache, item, cache_env, input_signature)
 
+    chunk = get_scoop_env('chunk', int) or 1
+    concurrency = get_scoop_env('concurrency', int) or 1
+    if concurrency > 1:
+        # a worker call needs at least concurrency commands to keep its subprocesses busy
+        chunk = max(chunk, concurrency)
+    if chunk > 1:
+        worker_func = worker_run_chunk
+        items = chunked(items, chunk)
+
+    usage_summary = None
+    if get_accounting():
+        usage_summary = UsageSummary()
+
+    stream, ordered, window = get_result_stream()
+    try:
+        _log.debug("main_run: going to start map (ordered %s window %s tasks %s chunk %s)",
+                   ordered, window, tasks, chunk)
+        for item, result in stream_map(worker_func, items, ordered=ordered, window=window, lookup=lookup,
+                                       speculate=get_scoop_env('speculate', float)):
+            if chunk > 1:
+                pairs = zip(item, result)
+            else:
+                pairs = [(item, result)]
+            for item, result in pairs:
+                if tasks is None:
+                    record = make_record(item, result)
+                else:
+                    record = make_record(item[0], result)
+                stream.write(record)
+                if usage_summary is not None:
+                    usage_summary.add(record.get('usage'))
+                if journal is not None:
+                    journal.write(record)
+                if cache is not None and record['ec'] == 0:
+                    entry = make_cache_entry(result)
+                    if entry is not None:
+                        cache.put(make_cache_key(item, cache_env, input_signature), entry)
+        _log.debug("main_run: finished map with %s results", stream.nr_results)
+    except:
+        _log.exception("main_run: main failed with main_func %s with items %s", worker_func, items)
 
+    stream.close()
+    if usage_summary is not None:
+        sys.stderr.write(usage_summary.report())
+    if journal is not None:
+        journal.close()
+    if cache is not None:
+        cache.evict()
@@ -26,24 +26,80 @@
 """
 A collection of functions and constants to use within worker modules
 """
+import gzip
+import hashlib
+import json
+import logging
+import logging.handlers
 import os
+import socket
 import stat
 import sys
+import time
+from collections import deque
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from vsc.utils import fancylogger
 from vsc.utils.fancylogger import getLogger, setLogLevelDebug, logToFile, disableDefaultHandlers
+from vsc.mympirun.scoop.topology import PROC_STATUS, read_file, parse_cpulist
 
 SCOOP_ENVIRONMENT_PREFIX = 'SCOOP'
 SCOOP_ENVIRONMENT_SEPARATOR = "_"
 
+_ENVIRONMENT_CACHE = {}
+
+RESULTS_FORMATS = ['jsonl', 'pickle']
+RESULTS_ORDERS = ['counter', 'completion']
+RESULTS_WINDOW = 10000
+RESULTS_FLUSH_INTERVAL = 1.0  # seconds
+
+JOURNAL_SYNC_RECORDS = 1000
+JOURNAL_SYNC_INTERVAL = 10.0  # seconds
+
+CACHE_EVICT_PUTS = 1000  # check the size of the cache every so many new entries
+
+LOG_DIR_DEFAULT = '/tmp'
+LOG_BUFFER_RECORDS = 1000  # log records are written in batches of this size (warnings and errors at once)
+
+_worker_context = None
+
+def get_worker_log_filename(logfn_name):
+    """Return the log file of this worker, one per worker in SCOOP_LOG_DIR (default LOG_DIR_DEFAULT)"""
+    context = get_worker_context()
+    if context.rank is None:
+        worker = "pid%s" % os.getpid()
+    else:
+        worker = context.rank
+    log_dir = get_scoop_env('log_dir') or LOG_DIR_DEFAULT
+    return os.path.join(log_dir, 'scoop_%s_%s_%s.log' % (logfn_name, context.host, worker))
+
 def make_worker_log(name, debug=False, logfn_name=None, disable_defaulthandlers=False):
-    """Make a basic log object"""
+    """Make a basic log object
+        every worker logs to its own file (see get_worker_log_filename), the records are buffered
+        debug level is also set with SCOOP_LOG_DEBUG
+        (pass the arguments to the log calls, eg _log.debug("x %s", x), so nothing is formatted below the level)
+    """
     if logfn_name is None:
         logfn_name = name
-    logfn = '/tmp/scoop_%s.log' % logfn_name
+    logfn = get_worker_log_filename(logfn_name)
 
-    if debug:
+    if debug or get_scoop_env_bool('log_debug'):
         setLogLevelDebug()
 
-    logToFile(logfn, name=name)
+    log_dir = os.path.dirname(logfn)
+    if not os.path.isdir(log_dir):
+        try:
+            os.makedirs(log_dir)
+        except OSError:
+            if not os.path.isdir(log_dir):
+                raise
+    target = logging.FileHandler(logfn)
+    target.setFormatter(logging.Formatter(fancylogger.FANCYLOG_LOGGING_FORMAT or fancylogger.DEFAULT_LOGGING_FORMAT))
+    # written when the buffer is full, on a warning and at exit (logging.shutdown)
+    handler = logging.handlers.MemoryHandler(LOG_BUFFER_RECORDS, flushLevel=logging.WARNING, target=target)
+    logToFile(logfn, name=name, filehandler=handler)
     os.chmod(logfn, stat.S_IRUSR | stat.S_IWUSR)
 
     if disable_defaulthandlers:
@@ -86,6 +142,480 @@ def get_scoop_env_bool(name):
     else:
         return True
 
+class WorkerContext(object):
+    """Placement of this worker, from the SCOOP_WORKER_* variables set by the bootstrap
+        immutable, use get_worker_context() to get the one instance of the worker
+        name: worker name, rank: global rank (the origin is 0), size: number of workers (None if unknown)
+        host: hostname, host_index: index of the worker on its host, host_workers: number of workers on the host
+        cpus: tuple with the cpus of the worker (planned or current affinity), numa_node: planned NUMA node (or None)
+        origin, freeorigin: bools
+    """
+    __slots__ = ('name', 'rank', 'size', 'host', 'host_index', 'host_workers', 'cpus', 'numa_node',
+                 'origin', 'freeorigin')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("WorkerContext is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("WorkerContext is immutable")
+
+    def __repr__(self):
+        return "WorkerContext(%s)" % ', '.join(["%s=%r" % (name, getattr(self, name)) for name in self.__slots__])
+
+    @classmethod
+    def from_environment(cls):
+        """Parse the context from the environment"""
+        try:
+            import scoop  # do the import only here
+            size = getattr(scoop, 'SIZE', None)
+        except ImportError:
+            size = None
+
+        cpus = get_scoop_env('worker_cpus')
+        if cpus is None:
+            for line in (read_file(PROC_STATUS, '') or '').splitlines():
+                if line.startswith('Cpus_allowed_list:'):
+                    cpus = line.split(':', 1)[1]
+        cpus = tuple(parse_cpulist(cpus or ''))
+
+        return cls(get_scoop_env('worker_name'),
+                   get_scoop_env('worker_rank', int),
+                   size,
+                   socket.gethostname(),
+                   get_scoop_env('worker_host_index', int),
+                   get_scoop_env('worker_host_workers', int),
+                   cpus,
+                   get_scoop_env('worker_numa_node', int),
+                   get_scoop_env_bool('worker_origin'),
+                   get_scoop_env_bool('worker_freeorigin'),
+                   )
+
+    def local_path(self, base, *parts):
+        """Return a path for this worker under base (eg node-local scratch), unique on the host"""
+        index = self.host_index
+        if index is None:
+            index = "pid%s" % os.getpid()
+        return os.path.join(base, "worker_%s" % index, *parts)
+
+def get_worker_context():
+    """Return the WorkerContext of this worker (parsed once)"""
+    global _worker_context
+    if _worker_context is None:
+        _worker_context = WorkerContext.from_environment()
+    return _worker_context
+
+def write_environment(filename, environment):
+    """Write the environment snapshot (dict name:value) as compressed json
+        value None means the variable is removed
+    """
+    fh = gzip.open(filename, 'wb')
+    fh.write(json.dumps(environment).encode('utf-8'))
+    fh.close()
+    os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR)
+
+def load_environment(filename):
+    """Read the environment snapshot (only once per process)"""
+    if not filename in _ENVIRONMENT_CACHE:
+        fh = gzip.open(filename, 'rb')
+        _ENVIRONMENT_CACHE[filename] = json.loads(fh.read().decode('utf-8'))
+        fh.close()
+    return _ENVIRONMENT_CACHE[filename]
+
+def apply_environment(filename):
+    """Set the variables from the environment snapshot"""
+    for name, value in load_environment(filename).items():
+        if value is None:
+            os.environ.pop(str(name), None)
+        else:
+            os.environ[str(name)] = str(value)
+
+class _Resolved(object):
+    """Stands in for the future of a result that is known without running it"""
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+def stream_map(func, iterable, ordered=True, window=RESULTS_WINDOW, lookup=None, speculate=None):
+    """Run func on all items of iterable with at most window futures outstanding
+        yields (item, result) as they complete, in the order of iterable if ordered
+        (the outstanding futures are the reorder buffer)
+        lookup is called for each item, if it returns a result (not None) the item is not submitted
+        speculate is a fraction: once all items are submitted and that fraction of them is done,
+            the outstanding ones are submitted once more and the first result is used (stragglers)
+    """
+    from scoop import futures  # do the import only here
+
+    items = iter(iterable)
+    pending = deque()  # [item, future, duplicate future] in submit order
+    ready = deque()  # (item, result) looked up, only used when not ordered
+    counts = {'submitted': 0, 'done': 0, 'speculated': False}
+
+    def submit(nr):
+        """Submit up to nr items, returns False when there are no more items"""
+        for _ in range(nr):
+            try:
+                item = next(items)
+            except StopIteration:
+                return False
+            result = None
+            if lookup is not None:
+                result = lookup(item)
+            if result is None:
+                pending.append([item, futures.submit(func, item), None])
+                counts['submitted'] += 1
+            elif ordered:
+                pending.append([item, _Resolved(result), None])
+            else:
+                ready.append((item, result))
+        return True
+
+    def speculate_now(more):
+        """Time to submit the outstanding items once more"""
+        return (speculate is not None and not more and not counts['speculated'] and
+                counts['done'] >= speculate * counts['submitted'])
+
+    def duplicate():
+        """Submit the outstanding items once more"""
+        counts['speculated'] = True
+        for entry in pending:
+            if entry[2] is None and not isinstance(entry[1], _Resolved) and not entry[1].done():
+                entry[2] = futures.submit(func, entry[0])
+
+    more = submit(window)
+    if ordered:
+        while pending:
+            if speculate_now(more):
+                duplicate()
+            item, future, duplicate_future = pending.popleft()
+            if duplicate_future is not None:
+                future = futures.wait([future, duplicate_future], return_when=futures.FIRST_COMPLETED).done.pop()
+            yield item, future.result()
+            if not isinstance(future, _Resolved):
+                counts['done'] += 1
+            if more:
+                more = submit(1)
+    else:
+        # resubmit once half of the window completed, so every wait is amortised over many results
+        refill = max(1, window // 2)
+        while pending or ready:
+            while ready:
+                yield ready.popleft()
+            if not pending:
+                if more:
+                    more = submit(window)
+                continue
+            if speculate_now(more):
+                duplicate()
+
+            entry_of = {}
+            for entry in pending:
+                entry_of[entry[1]] = entry
+                if entry[2] is not None:
+                    entry_of[entry[2]] = entry
+            remaining = len(pending)
+            nr_done = 0
+            for future in futures.as_completed(list(entry_of.keys())):
+                entry = entry_of[future]
+                if entry[1] is None:
+                    # the other copy was first
+                    continue
+                entry[1] = None
+                yield entry[0], future.result()
+                counts['done'] += 1
+                nr_done += 1
+                remaining -= 1
+                if remaining == 0 or (more and nr_done >= refill) or speculate_now(more):
+                    # don't wait for the copies that lost
+                    break
+            pending = deque([entry for entry in pending if entry[1] is not None])
+            if more:
+                more = submit(window - len(pending))
+
+def _make_jsonable(value):
+    """Decode (non utf-8) strings in value, so it can be dumped as json"""
+    if isinstance(value, str) and not isinstance(value, type(u'')):
+        return value.decode('utf-8', 'replace')
+    elif isinstance(value, (list, tuple)):
+        return [_make_jsonable(x) for x in value]
+    elif isinstance(value, dict):
+        return dict([(k, _make_jsonable(v)) for k, v in value.items()])
+    else:
+        return value
+
+def _dump_json(record):
+    """Return record as json (non utf-8 strings are decoded with replacement characters)"""
+    try:
+        return json.dumps(record)
+    except UnicodeDecodeError:
+        return json.dumps(_make_jsonable(record))
+
+class ResultStream(object):
+    """Write results one at a time, as json lines or as consecutive pickles
+        filename '-' is stdout; flushed at most every RESULTS_FLUSH_INTERVAL seconds
+    """
+    def __init__(self, filename='-', fmt='jsonl'):
+        if not fmt in RESULTS_FORMATS:
+            raise ValueError("Unknown results format %s (supported %s)" % (fmt, RESULTS_FORMATS))
+        self.fmt = fmt
+        if filename == '-':
+            self.fh = sys.stdout
+        else:
+            self.fh = open(filename, 'wb')
+        self.last_flush = time.time()
+        self.nr_results = 0
+
+    def write(self, record):
+        """Write one result"""
+        if self.fmt == 'jsonl':
+            self.fh.write(_dump_json(record) + "\n")
+        else:
+            pickle.dump(record, self.fh, pickle.HIGHEST_PROTOCOL)
+        self.nr_results += 1
+
+        if time.time() - self.last_flush > RESULTS_FLUSH_INTERVAL:
+            self.fh.flush()
+            self.last_flush = time.time()
+
+    def close(self):
+        """Flush and close (stdout is only flushed)"""
+        self.fh.flush()
+        if not self.fh is sys.stdout:
+            self.fh.close()
+
+class Journal(object):
+    """Append-only json lines journal of the completed results (dicts with a counter and ec)
+        fsync'ed every JOURNAL_SYNC_RECORDS records or JOURNAL_SYNC_INTERVAL seconds, and on close
+        done holds the counters with a successful result (ec 0) in the journal when it was opened,
+        failed ones (eg killed after a timeout) run again (a truncated last line is ignored)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = set()
+
+        ends_with_newline = True
+        if os.path.exists(filename):
+            fh = open(filename, 'rb')
+            for line in fh:
+                ends_with_newline = line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                    if record['ec'] == 0:
+                        self.done.add(record['counter'])
+                except (ValueError, KeyError, TypeError):
+                    # eg the last line when the job was killed while writing it
+                    pass
+            fh.close()
+
+        self.fh = open(filename, 'ab')
+        if not ends_with_newline:
+            self.fh.write("\n")
+        self.nr_unsynced = 0
+        self.last_sync = time.time()
+
+    def write(self, record):
+        """Append one result"""
+        self.fh.write(_dump_json(record) + "\n")
+        self.nr_unsynced += 1
+        if self.nr_unsynced >= JOURNAL_SYNC_RECORDS or time.time() - self.last_sync > JOURNAL_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """Flush and fsync the journal"""
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.nr_unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self.fh.close()
+
+class ResultCache(object):
+    """Content-addressed cache of results (pickled), in a (shared or node-local) directory
+        entries are kept at most max_size bytes in total, least recently used ones are removed first
+        (a hit updates the mtime of the entry)
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.nr_puts = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def make_key(*parts):
+        """Return the key for the parts (strings)"""
+        return hashlib.sha256("\0".join(["%s" % x for x in parts])).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the cached result for key, None if not cached"""
+        path = self._path(key)
+        try:
+            fh = open(path, 'rb')
+            result = pickle.load(fh)
+            fh.close()
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """Store result for key (if not cached yet)"""
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.mkdir(dirname)
+            except OSError:
+                pass
+        # rename is atomic, other processes never see a partial entry
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        fh = open(tmp, 'wb')
+        pickle.dump(result, fh, pickle.HIGHEST_PROTOCOL)
+        fh.close()
+        os.rename(tmp, path)
+
+        self.nr_puts += 1
+        if self.nr_puts % CACHE_EVICT_PUTS == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is at most max_size bytes"""
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class UsageSummary(object):
+    """Totals of the resource usage dicts of the tasks, per worker and per host
+        (wall, utime, stime and the I/O counters are summed, maxrss is the maximum of the known ones)
+    """
+    SUMMED = ['wall', 'utime', 'stime', 'rchar', 'wchar', 'read_bytes', 'write_bytes']
+
+    def __init__(self):
+        self.workers = {}
+        self.hosts = {}
+
+    def _add(self, totals, key, usage):
+        total = totals.setdefault(key, dict([('tasks', 0), ('maxrss', 0)] + [(x, 0) for x in self.SUMMED]))
+        total['tasks'] += 1
+        total['maxrss'] = max(total['maxrss'], usage.get('maxrss') or 0)
+        for name in self.SUMMED:
+            total[name] += usage.get(name, 0)
+
+    def add(self, usage):
+        """Add the usage of one task (None is ignored)"""
+        if usage is None:
+            return
+        self._add(self.workers, (usage.get('host'), usage.get('worker')), usage)
+        self._add(self.hosts, usage.get('host'), usage)
+
+    def _format(self, total):
+        cpu = total['utime'] + total['stime']
+        return ("tasks %d wall %.1fs user %.1fs sys %.1fs cpu/wall %.2f maxrss %.1fMB "
+                "read %.1fMB write %.1fMB (storage read %.1fMB write %.1fMB)" %
+                (total['tasks'], total['wall'], total['utime'], total['stime'], cpu / (total['wall'] or 1),
+                 total['maxrss'] / 1024.0, total['rchar'] / 1048576.0, total['wchar'] / 1048576.0,
+                 total['read_bytes'] / 1048576.0, total['write_bytes'] / 1048576.0))
+
+    def report(self):
+        """Return the summary as text"""
+        lines = []
+        for (host, worker), total in sorted(self.workers.items()):
+            lines.append("usage worker %s on %s: %s" % (worker, host, self._format(total)))
+        for host, total in sorted(self.hosts.items()):
+            lines.append("usage host %s: %s" % (host, self._format(total)))
+        return ''.join(["%s\n" % x for x in lines])
+
+def get_input_signature(filenames, content=False):
+    """Return a signature of the files: mtime and size, or a hash of the content"""
+    signature = []
+    for filename in filenames:
+        try:
+            if content:
+                sha = hashlib.sha256()
+                fh = open(filename, 'rb')
+                for data in iter(lambda: fh.read(1024 * 1024), ''):
+                    sha.update(data)
+                fh.close()
+                signature.append("%s:%s" % (filename, sha.hexdigest()))
+            else:
+                st = os.stat(filename)
+                signature.append("%s:%s:%s" % (filename, st.st_mtime, st.st_size))
+        except (IOError, OSError):
+            signature.append("%s:missing" % filename)
+    return ';'.join(signature)
+
+def get_result_stream():
+    """Return the ResultStream and stream_map options set by myscoop (SCOOP_RESULTS* variables)
+        returns ResultStream, ordered, window
+    """
+    stream = ResultStream(filename=get_scoop_env('results') or '-', fmt=get_scoop_env('results_format') or 'jsonl')
+    ordered = (get_scoop_env('results_order') or 'counter') == 'counter'
+    window = get_scoop_env('results_window', int) or RESULTS_WINDOW
+    return stream, ordered, window
+
+def chunked(iterable, size):
+    """Yield lists of (at most) size consecutive items of iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def read_tasks(filename):
+    """Yield (line number, line) for the non-empty lines of filename (- is stdin), read lazily"""
+    if filename == '-':
+        fh = sys.stdin
+    else:
+        fh = open(filename)
+    try:
+        for idx, line in enumerate(fh):
+            line = line.rstrip('\n')
+            if line.strip():
+                yield idx, line
+    finally:
+        if not fh is sys.stdin:
+            fh.close()
+
 def parse_worker_args(executable=True):
     """Parse the arguments
         check if first arg matches [start:]stop[:step]
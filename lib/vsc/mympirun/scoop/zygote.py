@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Ghent University
+# Copyright 2012-2013 Stijn De Weirdt
+#
+# This file is part of VSC-tools,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Hercules foundation (http://www.herculesstichting.be/in_English)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# http://github.com/hpcugent/VSC-tools
+#
+# VSC-tools is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# VSC-tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with VSC-tools. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Per-host zygote: import the bootstrap, scoop and the worker module once, then fork the workers
+
+The only argument is the (compressed, base64 encoded) json dict with
+    executable: the worker module (imported without running its __main__ part)
+    args: the arguments of the worker module
+    workers: list with the bootstrap arguments of each worker on this host
+Each forked worker runs MyBootstrap with its own arguments,
+so nice level and affinity are set after the fork (the cpus are planned from the topology of this node,
+read once here), and it gets its own zmq context
+(the one scoop creates when it is imported here is not fork-safe).
+SIGTERM and SIGHUP are passed on to the workers.
+"""
+import base64
+import json
+import logging
+import os
+import runpy
+import signal
+import sys
+import traceback
+import zlib
+
+# run_name used to import the worker module in the zygote
+PRELOAD_RUN_NAME = '__scoop_zygote__'
+
+
+def encode_workers(executable, args, workers):
+    """Encode the zygote argument (shell safe)"""
+    txt = json.dumps({'executable': executable, 'args': args, 'workers': workers})
+    return base64.b64encode(zlib.compress(txt.encode('utf-8'))).decode('ascii')
+
+
+def decode_workers(txt):
+    """Decode the zygote argument"""
+    return json.loads(zlib.decompress(base64.b64decode(txt)).decode('utf-8'))
+
+
+def preload(executable, args):
+    """Import the worker module and everything it imports, without its __main__ part"""
+    if not executable:
+        return
+
+    argv = sys.argv
+    sys.argv = [executable] + args
+    sys.path.append(os.path.dirname(os.path.abspath(executable)))
+    try:
+        runpy.run_path(executable, run_name=PRELOAD_RUN_NAME)
+    except (Exception, SystemExit):
+        sys.stderr.write("zygote: preload of %s failed (workers will import it themselves)\n%s" %
+                         (executable, traceback.format_exc()))
+    sys.path.pop()
+    sys.argv = argv
+
+
+def preload_environment(workers):
+    """Read the environment snapshot once for all workers"""
+    from vsc.mympirun.scoop.worker_utils import load_environment
+
+    for argv in workers:
+        if '--environment' in argv:
+            load_environment(argv[argv.index('--environment') + 1])
+
+
+def preload_topology(workers):
+    """Read the topology of this node once for all workers that plan their cpus from it"""
+    from vsc.mympirun.scoop.topology import PLANNED_ALGORITHMS, get_topology
+
+    for argv in workers:
+        if '--affinity' in argv and argv[argv.index('--affinity') + 1].split(':')[0] in PLANNED_ALGORITHMS:
+            get_topology()
+            return
+
+
+def reset_zmq_context():
+    """Give the forked worker a zmq context of its own
+        scoop creates the context of its communicator when it is imported (in the zygote, before the fork),
+        its I/O threads don't exist in the forked worker
+    """
+    try:
+        import zmq
+    except ImportError:
+        return
+    try:
+        from scoop._comm.scoopzmq import ZMQCommunicator
+    except ImportError:
+        # older scoop
+        try:
+            from scoop._comm import ZMQCommunicator
+        except ImportError:
+            return
+    # the inherited context is not terminated, pyzmq leaves contexts of another process alone
+    ZMQCommunicator.context = zmq.Context()
+
+
+def run_worker(argv):
+    """Run the bootstrap in the forked worker, never returns"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    reset_zmq_context()
+
+    from vsc.mympirun.scoop.bootstrap import MyBootstrap
+
+    sys.argv = [sys.argv[0]] + argv
+    ec = 0
+    try:
+        MyBootstrap().main()
+    except SystemExit:
+        ec = sys.exc_info()[1].code
+    except:
+        traceback.print_exc()
+        ec = 1
+
+    # os._exit skips the atexit handlers, write the buffered logs
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if not isinstance(ec, int):
+        ec = int(ec is not None)
+    os._exit(ec)
+
+
+def main():
+    """Import once, fork all workers and wait for them"""
+    if len(sys.argv) < 2:
+        sys.stderr.write("usage: %s <encoded workers>\n" % sys.argv[0])
+        sys.exit(1)
+
+    spec = decode_workers(sys.argv[1])
+
+    # the expensive imports, shared with all workers
+    import vsc.mympirun.scoop.bootstrap
+    try:
+        import zmq
+    except ImportError:
+        pass
+    preload(spec['executable'], spec['args'])
+    preload_environment(spec['workers'])
+    preload_topology(spec['workers'])
+
+    origin_pid = None
+    pids = []
+    zygote_pid = os.getpid()
+
+    def terminate(signum, frame):
+        """Pass the signal on to the workers"""
+        if os.getpid() != zygote_pid:
+            # a worker that got the signal before it reset the handler
+            os._exit(128 + signum)
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+    for argv in spec['workers']:
+        # avoid duplicate output from buffers
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            run_worker(argv)
+        pids.append(pid)
+        if '--origin' in argv:
+            origin_pid = pid
+
+    ec = 0
+    origin_ec = None
+    for pid in pids:
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFSIGNALED(status):
+            pid_ec = 128 + os.WTERMSIG(status)
+        else:
+            pid_ec = os.WEXITSTATUS(status)
+        if pid == origin_pid:
+            origin_ec = pid_ec
+        ec = max(ec, pid_ec)
+
+    if origin_ec is not None:
+        ec = origin_ec
+    sys.exit(ec)
+
+if __name__ == '__main__':
+    main()